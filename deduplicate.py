@@ -0,0 +1,46 @@
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+
+DEDUPLICATE_MODES = ["hardlink", "copy"]
+READ_SIZE = 1 << 20 # bytes
+
+
+def pair_key(paths: list[Path], filter_names: list[str]) -> str:
+    """
+    Hash the content of the input files of a job and its filters, identical jobs have identical keys.
+    """
+    key = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        with open(path, "rb") as file:
+            while chunk := file.read(READ_SIZE):
+                key.update(chunk)
+        key.update(b"\0" + str(path.stat().st_size).encode() + b"\0") # separate the files
+    key.update(" ".join(filter_names).encode())
+    return key.hexdigest()
+
+
+def link_duplicate(source_path: Path, destination_path: Path, mode: str = "hardlink") -> None:
+    """
+    Write the result of an identical job as a hardlink (or a copy where hardlinks are not supported).
+    """
+    assert mode in DEDUPLICATE_MODES
+    if destination_path.exists():
+        destination_path.unlink()
+    if mode == "hardlink":
+        try:
+            os.link(source_path, destination_path)
+            return
+        except OSError: # e.g. another file system
+            pass
+    shutil.copyfile(source_path, destination_path)
+
+
+def unlink_shared(path: Path) -> None:
+    """
+    Remove an output that is hardlinked to other outputs, so writing it does not change them too.
+    """
+    if path.exists() and path.stat().st_nlink > 1:
+        path.unlink()
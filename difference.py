@@ -1,14 +1,21 @@
-from transform import signed, multi_linear_transform, resized_to_shape, sign_unshifted_image, max_luminance
+from transform import multi_linear_transform, resized_to_shape, max_luminance
 from patch import unpack
 from cli import RESET, RED, GREEN, ORANGE, BLUE, MAGENTA, CYAN, BOLD
 from traverse import check_out_path, print_indented
+from progress import create_json_reporter, count_images, silent
+from metadata import read_image, read_image_and_metadata, write_image
+from parallel import run_in_bands, create_ordered_runner
+from memory import estimate_memory
 
+import time
 import cv2
 import numpy as np
 from pathlib import Path
+from typing import Callable
 
 
 SUFFIXES = [".png"] # FIXME: duplicate identifier
+UNPACK_ERRORS = (ValueError, AssertionError, ZeroDivisionError, IndexError) # raised by the scrambled footer of a filtered patch
 
 
 def scaled_stack(scale: np.ndarray, elements: list[np.ndarray]):
@@ -43,22 +50,31 @@ def create_difference_image(difference):
         return np.ones(difference.shape) * max_lum
 
 
-def compare_image(reference_path: Path, patched_path: Path, difference_path: Path|None = None) -> tuple[int, int]:
-    reference_image = cv2.imread(reference_path, cv2.IMREAD_UNCHANGED)
-    patched_image = cv2.imread(patched_path, cv2.IMREAD_UNCHANGED)
+def image_difference(reference_image: np.ndarray, patched_image: np.ndarray) -> np.ndarray:
     resized_image = resized_to_shape(reference_image, patched_image.shape)
-    
     patched: np.ndarray = patched_image.astype(np.int16 if patched_image.dtype == np.uint8 else np.int32)
     resized: np.ndarray = resized_image.astype(np.int16 if patched_image.dtype == np.uint8 else np.int32)
-    difference = resized - patched
+    return resized - patched
+
+
+def difference_image_path(difference_path: Path, reference_path: Path, patched_path: Path) -> Path:
+    return difference_path.with_stem(f"{difference_path.stem}-{reference_path.stem}-{patched_path.stem}")
+
+
+def compare_image(reference_path: Path, patched_path: Path, difference_path: Path|None = None) -> tuple[int, int]:
+    reference_image = cv2.imread(reference_path, cv2.IMREAD_UNCHANGED)
+    patched_image = cv2.imread(patched_path, cv2.IMREAD_UNCHANGED)
+    difference = image_difference(reference_image, patched_image)
     if difference_path:
         difference_image = create_difference_image(difference)
-        cv2.imwrite(difference_path.with_stem(f"{difference_path.stem}-{reference_path.stem}-{patched_path.stem}"), difference_image)
+        cv2.imwrite(difference_image_path(difference_path, reference_path, patched_path), difference_image)
     return int(difference.min()), int(difference.max())
 
 
-def compare_pack(reference_path: Path, patched_path: Path, difference_path: Path|None, print_full_path: bool = False, overwrite: bool = False) -> None:
+def compare_pack(reference_path: Path, patched_path: Path, difference_path: Path|None, print_full_path: bool = False, overwrite: bool = False, progress: str = "text") -> None:
     error_paths = []
+    show, show_message = (print_indented, print) if progress == "text" else (silent, silent)
+    report_job, report_summary = create_json_reporter(count_images(reference_path, SUFFIXES)) if progress == "json" else (silent, silent)
     def callback_dir(path: Path, level: int):
         text = path.name
         if images := [p for p in path.iterdir() if p.is_file and p.suffix.lower() in SUFFIXES]:
@@ -70,44 +86,186 @@ def compare_pack(reference_path: Path, patched_path: Path, difference_path: Path
             image_patched_path = patched_path.joinpath(relative_replacements_path)
             image_reference_path = reference_path.joinpath(relative_replacements_path)
             text = (image_reference_path if print_full_path else relative_replacements_path).as_posix()
-            print_indented("… " + text, level, end=(None if reference_path == None else "\r"))
+            show("… " + text, level, end=(None if reference_path == None else "\r"))
+            start, status, message = time.perf_counter(), "ok", None
             try:
                 if not image_patched_path.exists():
                     raise FileNotFoundError("Patched file does not exist")
-                elif not overwrite and image_processed_path.exists():
+                elif not overwrite and difference_path and difference_image_path(difference_path, image_reference_path, image_patched_path).exists():
                     raise FileExistsError("Not allowed to overwrite")
                 difference = compare_image(image_reference_path, image_patched_path, difference_path)
+                if difference != (0, 0):
+                    status, message = "failed", f"difference {difference}"
                 text2 = (f"{GREEN}✔{RESET}" if difference == (0, 0) else f"{RED}✖{RESET}") + " " + text + "\t" + f"({BLUE}{difference[0]}{RESET}, {RED}{difference[1]}{RESET})"
-                print_indented(text2, level, end="\n", flush=True) # https://symbolsdb.com/check-mark-symbol
+                show(text2, level, end="\n", flush=True) # https://symbolsdb.com/check-mark-symbol
             except FileNotFoundError as e:
-                print_indented(f"{ORANGE}✖{RESET} {text}", level, end="\t", flush=True)
-                print("warning:", str(e))
+                status, message = "warning", str(e)
+                show(f"{ORANGE}✖{RESET} {text}", level, end="\t", flush=True)
+                show_message("warning:", str(e))
             except FileExistsError as e:
-                print_indented(f"{GREEN}✖{RESET} {text} SKIPPED: {e}", level, end="\n", flush=True)
+                status, message = "skipped", str(e)
+                show(f"{GREEN}✖{RESET} {text} SKIPPED: {e}", level, end="\n", flush=True)
             except Exception as e:
                 error_paths.append(image_reference_path)
-                print_indented(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
-                print("error:", str(e))
+                show(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
+                show_message("error:", str(e))
+                report_job(text, "error", time.perf_counter() - start, [image_reference_path, image_patched_path], [], str(e))
                 raise e
-    check_out_path(reference_path, callback_dir, callback_file)
-    if error_paths:
+            report_job(text, status, time.perf_counter() - start, [image_reference_path, image_patched_path], [], message)
+    check_out_path(reference_path, callback_dir if progress == "text" else silent, callback_file)
+    report_summary()
+    if error_paths and progress == "text":
         print(f"Encountered {len(error_paths)} errors:")
         for path in error_paths:
             print("  " + str(path))
 
 
+def unpack_without_original(patch_image: np.ndarray, metadata: dict) -> tuple[np.ndarray, list[np.ndarray]]|None:
+    """
+    Unpack a patch as anyone could, without its original. Return None when its recorded filters scrambled the footer.
+    Patches recorded without filters must unpack, patches without metadata are taken as filtered when they don't.
+    """
+    if metadata.get("filters") == []:
+        return unpack(patch_image)
+    try:
+        return unpack(patch_image)
+    except UNPACK_ERRORS:
+        return None
+
+
+def reverse_original_image(modified_image: np.ndarray, patch_image: np.ndarray, threads: int = 1) -> np.ndarray:
+    return reverse_unpacked_image(modified_image, unpack(patch_image), threads)
+
+
+def reverse_unpacked_image(modified_image: np.ndarray, unpacked: tuple[np.ndarray, list[np.ndarray]], threads: int = 1) -> np.ndarray:
+    """
+    Reverse the original from the modified image and its unpacked patch with 0 for each noise value, since the seed is presumed unknown.
+    Without noise the difference is the sign unshifted patch, which is subtracted band by band instead of in full-size temporaries.
+    """
+    shifted_image, positive_maps = unpacked
+    _, hashed_is_positive = positive_maps # the noise is 0, so its sign doesn't matter
+    if modified_image.shape != shifted_image.shape:
+        raise ValueError(f"The modified image {modified_image.shape} doesn't match the patch {shifted_image.shape}")
+    signed_type = np.int16 if shifted_image.dtype == np.uint8 else np.int32
+    negative_offset = max_luminance(np.dtype(signed_type)) + 1 # like sign_unshifted_image
+    reversed_image = np.empty(shifted_image.shape, dtype=shifted_image.dtype)
+    def reverse_band(rows: slice):
+        difference = shifted_image[rows].astype(signed_type)
+        difference[~hashed_is_positive[rows]] -= negative_offset
+        np.subtract(modified_image[rows], difference, out=difference, dtype=signed_type)
+        reversed_image[rows] = difference # wraps around like astype()
+    run_in_bands(reverse_band, shifted_image.shape[0], threads)
+    return reversed_image
+
+
+def difference_stats(reference_image: np.ndarray, image: np.ndarray, threads: int = 1) -> dict:
+    """
+    Return the (min, max) difference of an image with a reference, the mean absolute difference and the share of exactly
+    recovered elements, in a single pass over bands of rows.
+    """
+    resized_image = resized_to_shape(reference_image, image.shape)
+    signed_type = np.int16 if max(reference_image.dtype.itemsize, image.dtype.itemsize) == 1 else np.int32 # a 16 bit original doesn't fit in int16
+    bands = {} # first row -> min, max, absolute sum and zeros of the band
+    def stats_band(rows: slice):
+        difference = resized_image[rows].astype(signed_type)
+        np.subtract(difference, image[rows], out=difference, dtype=signed_type)
+        bands[rows.start] = (int(difference.min()), int(difference.max()), int(np.abs(difference).sum(dtype=np.int64)), difference.size - np.count_nonzero(difference))
+    run_in_bands(stats_band, image.shape[0], threads)
+    minima, maxima, sums, zeros = zip(*bands.values())
+    return {
+        "difference": (min(minima), max(maxima)),
+        "mean": round(sum(sums) / image.size, 3), # the higher, the better the original is protected
+        "recovered": round(sum(zeros) / image.size, 4),
+    }
+
+
 def reverse_original(modified_path: Path, patch_path: Path, reversed_path: Path) -> None:
-    modified_image = cv2.imread(modified_path, cv2.IMREAD_UNCHANGED)
-    patch_image = cv2.imread(patch_path, cv2.IMREAD_UNCHANGED)
-    shifted_image, positive_maps = unpack(patch_image)
-    difference_is_positive, hashed_is_positive = positive_maps
-
-    shifted = shifted_image.astype(np.int16 if shifted_image.dtype == np.uint8 else np.int32) # FIXME
-    hashed = sign_unshifted_image(hashed_is_positive, shifted)
-    
-    noise: np.ndarray = np.zeros(hashed.shape).astype(np.int16 if shifted_image.dtype == np.uint8 else np.int32) # FIXME
-    difference = hashed + signed(difference_is_positive, noise)
-    modified: np.ndarray = modified_image.astype(np.int16 if shifted_image.dtype == np.uint8 else np.int32) # FIXME
-    resized = modified - difference
-    reversed_image: np.ndarray = resized.astype(np.uint8)
-    cv2.imwrite(reversed_path, reversed_image)
\ No newline at end of file
+    modified_image = read_image(modified_path)
+    patch_image = read_image(patch_path)
+    reversed_image = reverse_original_image(modified_image, patch_image)
+    write_image(reversed_path, reversed_image)
+
+
+def reverse_pack(modified_path: Path, patch_path: Path, reversed_path: Path|None = None, original_path: Path|None = None, print_full_path: bool = False, overwrite: bool = False, threads: int = 1, progress: str = "text", workers: int = 1, memory_budget: int|None = None) -> None:
+    """
+    Reverse every patch of a directory with its modified image, to audit whether the patches protect the originals.
+    Reversed images are only written when a reversed directory is given. With an original directory, every reversed image
+    is compared with its original instead, an image fails when its original is recovered exactly.
+    """
+    error_paths = []
+    jobs = []
+    statuses: list[str] = [] # appended from the workers
+    run_ordered, printers_of = create_ordered_runner(progress)
+    report_job, report_summary = create_json_reporter(count_images(patch_path, SUFFIXES)) if progress == "json" else (silent, silent)
+    def callback_dir(path: Path, level: int, show: Callable[..., None] = print_indented):
+        text = path.name
+        if images := [p for p in path.iterdir() if p.is_file and p.suffix.lower() in SUFFIXES]:
+            text += f" ({len(images)})"
+        show(f"{BOLD}{MAGENTA}{text}{RESET}", level)
+    def callback_file(image_patch_path: Path, level: int):
+        if image_patch_path.suffix not in SUFFIXES:
+            return
+        relative_replacements_path = image_patch_path.relative_to(patch_path)
+        image_modified_path = modified_path.joinpath(relative_replacements_path)
+        image_original_path = original_path.joinpath(relative_replacements_path) if original_path else None
+        image_reversed_path = reversed_path.joinpath(relative_replacements_path) if reversed_path else None
+        input_paths = [image_modified_path, image_patch_path] + ([image_original_path] if image_original_path else [])
+        text = (image_patch_path if print_full_path else relative_replacements_path).as_posix()
+        show, show_message, flush_shown = printers_of(image_patch_path)
+        show("… " + text, level, end="\r")
+        start, status, message, details = time.perf_counter(), "ok", None, None
+        try:
+            if not image_modified_path.exists():
+                raise FileNotFoundError("Modified file does not exist")
+            elif image_original_path and not image_original_path.exists():
+                raise FileNotFoundError("Original file does not exist")
+            elif image_reversed_path and not overwrite and image_reversed_path.exists():
+                raise FileExistsError("Not allowed to overwrite")
+            modified_image, (patch_image, metadata) = read_image(image_modified_path), read_image_and_metadata(image_patch_path)
+            if modified_image is None or patch_image is None:
+                raise ValueError("Could not read the modified image or the patch")
+            unpacked = unpack_without_original(patch_image, metadata) # filtered patches can't even be unpacked without their original
+            reversed_image = reverse_unpacked_image(modified_image, unpacked, threads) if unpacked else None # without the seed, as anyone could
+            if reversed_image is None:
+                status, details = "not-unpackable", {"reversed": None}
+                message = "the filtered patch can't be unpacked without its original" if "filters" in metadata else "the patch can't be unpacked, it has no metadata to tell whether it is filtered"
+                reversed_text = "not unpackable"
+            elif image_original_path:
+                details = difference_stats(read_image(image_original_path), reversed_image, threads)
+                if details["difference"] == (0, 0):
+                    status, message = "failed", "original recovered"
+                reversed_text = f"({BLUE}{details['difference'][0]}{RESET}, {RED}{details['difference'][1]}{RESET}) mean {details['mean']} recovered {details['recovered']:.2%}"
+            else:
+                reversed_text = ""
+            if reversed_image is not None and image_reversed_path:
+                image_reversed_path.parent.mkdir(parents=True, exist_ok=True)
+                write_image(image_reversed_path, reversed_image)
+            show((f"{RED}✖{RESET}" if status == "failed" else f"{GREEN}✔{RESET}") + f" {text}\t{reversed_text} {time.perf_counter() - start:.3f}s", level, flush=True)
+        except FileNotFoundError as e:
+            status, message = "warning", str(e)
+            show(f"{ORANGE}✖{RESET} {text}", level, end="\t", flush=True)
+            show_message("warning:", str(e))
+        except FileExistsError as e:
+            status, message = "skipped", str(e)
+            show(f"{GREEN}✖{RESET} {text} SKIPPED: {e}", level, flush=True)
+        except Exception as e:
+            status, message = "error", str(e)
+            error_paths.append(image_patch_path)
+            show(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
+            show_message("error:", str(e))
+        statuses.append(status)
+        flush_shown()
+        report_job(text, status, time.perf_counter() - start, input_paths, [image_reversed_path] if image_reversed_path and status == "ok" else [], message, details)
+    def collect_file(image_patch_path: Path, level: int):
+        image_modified_path = modified_path.joinpath(image_patch_path.relative_to(patch_path))
+        jobs.append((estimate_memory(image_modified_path, image_patch_path, is_patch=True), lambda: callback_file(image_patch_path, level)))
+    start = time.perf_counter()
+    if workers == 1:
+        check_out_path(patch_path, callback_dir if progress == "text" else silent, callback_file)
+    else:
+        run_ordered(patch_path, callback_dir, collect_file, lambda path: path.suffix in SUFFIXES, lambda: jobs, workers, memory_budget)
+    report_summary()
+    if progress == "text":
+        print(f"{statuses.count('ok')} reversed, {statuses.count('failed')} recovered, {statuses.count('not-unpackable')} not unpackable, {statuses.count('warning') + statuses.count('skipped')} skipped, {statuses.count('error')} errors in {time.perf_counter() - start:.1f}s")
+        for path in error_paths:
+            print("  " + str(path))
@@ -2,6 +2,7 @@ import numpy as np
 import typing
 
 from transform import max_luminance
+from parallel import row_bands, run_in_bands
 
 
 NOISE_VARIANCE = 96
@@ -25,12 +26,31 @@ def extract_seed(image: np.ndarray) -> np.ndarray:
 
 def create_noise_image(image: np.ndarray, variance: float = 20) -> np.ndarray:
     assert variance in range(0, max_luminance(image)+1), "variance not in image range"
-    height, width, _ = image.shape
-    np.random.seed(seed=extract_seed(image) % max_luminance(np.dtype(np.uint32)))
-    noise = np.random.rand(*image.shape) * variance * (1 if image.dtype == np.int16 else 256)
-    if noise.shape[2] > 3:
-        noise[:,:,3] = 0
-    return noise.astype(np.uint8 if image.dtype == np.int16 else np.uint16)
+    random_state = np.random.RandomState(seed=extract_seed(image) % max_luminance(np.dtype(np.uint32)))
+    noise = np.empty(image.shape, dtype=np.uint8 if image.dtype == np.int16 else np.uint16)
+    for rows in row_bands(image.shape[0]): # sequential, the random stream must stay identical to older patches
+        band = random_state.rand(*noise[rows].shape) * variance * (1 if image.dtype == np.int16 else 256)
+        if band.shape[2] > 3:
+            band[:,:,3] = 0
+        noise[rows] = band.astype(noise.dtype)
+    return noise
+
+
+def create_noise_images(images: np.ndarray, variance: float = 20) -> np.ndarray:
+    """
+    create_noise_image() for a stack of images, each seeded by itself.
+    A single random state is reseeded for every image, which is much cheaper than creating one per image.
+    """
+    assert variance in range(0, max_luminance(images)+1), "variance not in image range"
+    random_state = np.random.RandomState()
+    noise = np.empty(images.shape, dtype=np.uint8 if images.dtype == np.int16 else np.uint16)
+    for i, image in enumerate(images): # only one image of random values at a time
+        random_state.seed(extract_seed(image) % max_luminance(np.dtype(np.uint32)))
+        values = random_state.rand(*image.shape) * variance * (1 if images.dtype == np.int16 else 256)
+        if values.shape[2] > 3:
+            values[:,:,3] = 0
+        noise[i] = values
+    return noise
 
 
 def moving_average(y, window_width):
@@ -48,10 +68,10 @@ def smooth(y, box_pts):
 def create_noise_array(image: np.ndarray, seed_image: np.ndarray, variance: float, axis: int = 0, relative_variance: bool = True, smooth_pixels: int = 1) -> np.ndarray:
     assert len(image.shape) >= 2
     assert axis in [0, 1]
-    np.random.seed(seed=extract_seed(seed_image) % max_luminance(np.dtype(np.uint32)))
+    random_state = np.random.RandomState(seed=extract_seed(seed_image) % max_luminance(np.dtype(np.uint32)))
     length, max_variance = image.shape[axis - 0], image.shape[1 - axis]
     variance_ = (variance / 100 * max_variance) if relative_variance else variance
-    array = np.random.rand(length) * variance_
+    array = random_state.rand(length) * variance_
     if smooth_pixels > 1:
         averages = moving_average(array, smooth_pixels)
         half = smooth_pixels // 2
@@ -59,19 +79,22 @@ def create_noise_array(image: np.ndarray, seed_image: np.ndarray, variance: floa
     return array.astype(np.int32)
 
 
-def create_rolled_image(image: np.ndarray, shift: typing.Iterable[int], axis: int = 0) -> np.ndarray:
+def create_rolled_image(image: np.ndarray, shift: typing.Iterable[int], axis: int = 0, threads: int = 1) -> np.ndarray:
     assert len(image.shape) >= 2
-    copy = image.copy()
-    length = image.shape[axis]
-    # print(shift[:10])
-    for i in range(length):
-        idx = [slice(None)] * image.ndim
-        idx[axis] = i
-        idx = tuple(idx)
-        unrolled = image[idx]
-        rolled = np.roll(unrolled, (shift[i], *[0 for i in image.shape[2:]]), [i for i in range(len(image.shape[1:]))])
-        copy[idx] = rolled
-    return copy
+    assert axis in [0, 1]
+    length, rolled_length = image.shape[axis], image.shape[1 - axis]
+    rolled = np.empty_like(image)
+    def roll_band(band: slice): # every row (or column) i is rolled by shift[i], as two slice copies instead of np.roll
+        for i in range(band.start, band.stop):
+            idx = [slice(None)] * image.ndim
+            idx[axis] = i
+            idx = tuple(idx)
+            unrolled, copy = image[idx], rolled[idx]
+            offset = int(shift[i]) % rolled_length
+            copy[offset:] = unrolled[:rolled_length - offset]
+            copy[:offset] = unrolled[rolled_length - offset:]
+    run_in_bands(roll_band, length, threads)
+    return rolled
 
 
 def create_bar_inversed_image(image: np.ndarray) -> np.ndarray:
@@ -86,47 +109,47 @@ def channel_inverted(image: np.ndarray) -> np.ndarray:
     pass
 
 
-def filter_name_to_function(name: str): # callable
+def filter_name_to_function(name: str, threads: int = 1): # callable
     match name:
         case "roll-h":
             def f(image, seed_image):
                 shift = create_noise_array(image, seed_image, 10, relative_variance=True, smooth_pixels=40)
                 shift -= shift.min()
-                filtered = create_rolled_image(image, shift)
+                filtered = create_rolled_image(image, shift, threads=threads)
                 return filtered
             return f
         case "roll-v":
             def f(image, seed_image):
                 shift = create_noise_array(image, seed_image, 5, relative_variance=True, smooth_pixels=13, axis=1)
                 shift -= shift.min()
-                filtered = create_rolled_image(image, shift, axis=1)
+                filtered = create_rolled_image(image, shift, axis=1, threads=threads)
                 return filtered
             return f
         case "iroll-h":
             def f(image, seed_image):
                 shift = create_noise_array(image, seed_image, 10, relative_variance=True, smooth_pixels=40)
                 shift -= shift.min()
-                filtered = create_rolled_image(image, -shift)
+                filtered = create_rolled_image(image, -shift, threads=threads)
                 return filtered
             return f
         case "iroll-v":
             def f(image, seed_image):
                 shift = create_noise_array(image, seed_image, 5, relative_variance=True, smooth_pixels=13, axis=1)
                 shift -= shift.min()
-                filtered = create_rolled_image(image, -shift, axis=1)
+                filtered = create_rolled_image(image, -shift, axis=1, threads=threads)
                 return filtered
             return f
         case _:
             return lambda image: image
 
 
-def apply_filters(image: np.ndarray, seed_image: np.ndarray, fitler_names: list[str], inverted: bool = False):
+def apply_filters(image: np.ndarray, seed_image: np.ndarray, fitler_names: list[str], inverted: bool = False, threads: int = 1):
     if inverted:
         fitler_names = ["i" + name for name in reversed(fitler_names)]
     assert all([name in FITLER_NAMES for name in fitler_names])
     filtered = image.copy()
     for name in fitler_names:
-        filter_function = filter_name_to_function(name)
+        filter_function = filter_name_to_function(name, threads)
         filtered = filter_function(filtered, seed_image)
         # print("applying " + name)
     return filtered
@@ -0,0 +1,61 @@
+from cli import RESET, ORANGE, CYAN, BOLD
+from traverse import check_out_path, print_indented
+from progress import emit, silent, BYTES_IN_MEGABYTE
+from metadata import read_metadata
+
+from pathlib import Path
+
+
+SUFFIXES = [".png"]
+
+
+def describe_metadata(metadata: dict) -> str:
+    if "version" not in metadata: # older patches only hold a checksum, or nothing at all
+        return f"{ORANGE}no metadata{RESET} (created by an older version, or stripped by an optimizer)"
+    shape = "×".join(str(i) for i in metadata["shape"])
+    filters = " ".join(metadata["filters"]) if metadata["filters"] else "none"
+    return f"{shape} {metadata['dtype']}, filters: {filters}, noise variance: {metadata['noise']['variance']}, version {metadata['version']}"
+
+
+def decoded_size(metadata: dict) -> int:
+    """
+    Return the bytes of the decoded patched image, 0 when unknown.
+    """
+    if "shape" not in metadata:
+        return 0
+    size = {"uint8": 1, "uint16": 2}.get(metadata["dtype"], 0)
+    for i in metadata["shape"]:
+        size *= i
+    return size
+
+
+def inspect_patch(patch_path: Path, as_json: bool = False) -> None:
+    metadata = read_metadata(patch_path)
+    if as_json:
+        emit({"path": patch_path.as_posix(), **metadata})
+    else:
+        print(patch_path.name, describe_metadata(metadata))
+
+
+def inspect_patch_pack(patch_path: Path, print_full_path: bool = False, as_json: bool = False) -> None:
+    """
+    Print the metadata of every patch in a directory, only reading the chunks in front of the pixels.
+    """
+    totals = {"patches": 0, "described": 0, "bytes": 0}
+    def callback_dir(path: Path, level: int):
+        print_indented(f"{BOLD}{CYAN}{path.name}{RESET}", level)
+    def callback_file(image_patch_path: Path, level: int):
+        if image_patch_path.suffix not in SUFFIXES:
+            return
+        text = (image_patch_path if print_full_path else image_patch_path.relative_to(patch_path)).as_posix()
+        metadata = read_metadata(image_patch_path)
+        totals["patches"] += 1
+        totals["described"] += "version" in metadata
+        totals["bytes"] += decoded_size(metadata)
+        if as_json:
+            emit({"path": text, **metadata})
+        else:
+            print_indented(f"{text} {describe_metadata(metadata)}", level)
+    check_out_path(patch_path, silent if as_json else callback_dir, callback_file)
+    if not as_json:
+        print(f"{totals['patches']} patches, {totals['described']} with metadata, {totals['bytes'] / BYTES_IN_MEGABYTE:.1f} MB of decoded patched images")
@@ -0,0 +1,111 @@
+from patch import create_patched
+from deduplicate import pair_key
+from progress import emit, BYTES_IN_MEGABYTE
+
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+
+CACHE_MEGABYTES = 1000
+CACHE_SUFFIX = ".png"
+TEMPORARY_SUFFIX = ".tmp" + CACHE_SUFFIX # written first, so a cached texture is never read half written
+PREFETCH_WORKERS = 1 # in the background, next to the requested textures
+
+
+def resolve_texture(root_path: Path, relative_path: str|Path) -> Path:
+    path = root_path.joinpath(relative_path).resolve()
+    if not path.is_relative_to(root_path.resolve()):
+        raise ValueError(f"{relative_path} is outside of {root_path.as_posix()}")
+    return path
+
+
+def create_patched_cache(original_path: Path, patch_path: Path, cache_path: Path, filter_names: list[str] = [], max_bytes: int = CACHE_MEGABYTES * BYTES_IN_MEGABYTE, threads: int = 1, prefetch_workers: int = PREFETCH_WORKERS) -> tuple[Callable[[str|Path], tuple[Path, bool]], Callable[[list[str]], None], Callable[[], None]]:
+    """
+    Return a function that patches a texture, given its path relative to the patch directory, on its first request.
+    It returns the path of the patched texture in the cache, and whether it was cached already.
+    Patched textures are stored under a hash of their patch, original and filters, so a changed patch or original is patched again.
+    Beyond max_bytes, the least recently used textures are removed. The order is kept in their modification times, so it survives a restart.
+    Also return a function that patches textures in the background that are likely requested next, and one to stop doing so.
+    """
+    cache_path.mkdir(parents=True, exist_ok=True)
+    lock = threading.Lock()
+    entries: OrderedDict[str, int] = OrderedDict() # key -> bytes, least recently used first
+    for entry in sorted(os.scandir(cache_path), key=lambda entry: entry.stat().st_mtime_ns):
+        if entry.name.endswith(TEMPORARY_SUFFIX): # left by an interrupted run
+            os.unlink(entry.path)
+        elif entry.name.endswith(CACHE_SUFFIX):
+            entries[entry.name[:-len(CACHE_SUFFIX)]] = entry.stat().st_size
+    keys: dict[tuple, str] = {} # paths and their stats -> key, so files are only hashed again when changed
+    patching: dict[str, threading.Lock] = {} # key -> lock, so a texture requested while prefetched is only patched once
+    def key_of(image_original_path: Path, image_patch_path: Path) -> str:
+        original_stat, patch_stat = image_original_path.stat(), image_patch_path.stat()
+        stats = (image_original_path, image_patch_path, original_stat.st_mtime_ns, original_stat.st_size, patch_stat.st_mtime_ns, patch_stat.st_size)
+        if stats not in keys:
+            keys[stats] = pair_key([image_original_path, image_patch_path], filter_names)
+        return keys[stats]
+    def evict() -> None: # while holding the lock
+        used = sum(entries.values())
+        while used > max_bytes and len(entries) > 1: # the texture just patched is kept
+            key, size = entries.popitem(last=False)
+            cache_path.joinpath(key + CACHE_SUFFIX).unlink(missing_ok=True)
+            used -= size
+    def patched_path_of(relative_path: str|Path) -> tuple[Path, bool]:
+        image_patch_path = resolve_texture(patch_path, relative_path)
+        image_original_path = resolve_texture(original_path, relative_path)
+        key = key_of(image_original_path, image_patch_path)
+        cached_path = cache_path.joinpath(key + CACHE_SUFFIX)
+        with lock:
+            key_lock = patching.setdefault(key, threading.Lock())
+        with key_lock:
+            with lock:
+                if key in entries and cached_path.exists():
+                    entries.move_to_end(key)
+                    os.utime(cached_path)
+                    return cached_path, True
+            temporary_path = cache_path.joinpath(f"{key}.{threading.get_ident()}{TEMPORARY_SUFFIX}")
+            try:
+                create_patched(image_original_path, image_patch_path, temporary_path, filter_names, threads)
+                os.replace(temporary_path, cached_path)
+            finally:
+                temporary_path.unlink(missing_ok=True)
+            with lock:
+                entries[key] = cached_path.stat().st_size
+                evict()
+            return cached_path, False
+    executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="prefetch")
+    def prefetch(relative_paths: list[str]) -> None:
+        for relative_path in relative_paths:
+            executor.submit(patched_path_of, relative_path) # errors are reported when the texture is requested
+    def stop_prefetching() -> None:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return patched_path_of, prefetch, stop_prefetching
+
+
+def serve_patched_pack(original_path: Path, patch_path: Path, cache_path: Path, filter_names: list[str] = [], max_bytes: int = CACHE_MEGABYTES * BYTES_IN_MEGABYTE, threads: int = 1, prefetch_paths: list[str] = []) -> None:
+    """
+    Read texture paths relative to the patch directory from stdin, one per line, and answer each with a json line
+    holding the path of the patched texture in the cache. Meanwhile, prefetch_paths are patched in the background.
+    """
+    patched_path_of, prefetch, stop_prefetching = create_patched_cache(original_path, patch_path, cache_path, filter_names, max_bytes, threads)
+    prefetch(prefetch_paths)
+    emit({"event": "ready", "cache": cache_path.as_posix(), "prefetching": len(prefetch_paths)})
+    try:
+        for line in sys.stdin:
+            if not (relative_path := line.strip()):
+                continue
+            start = time.perf_counter()
+            try:
+                cached_path, is_cached = patched_path_of(relative_path)
+                emit({"event": "texture", "path": relative_path, "status": "hit" if is_cached else "miss", "patched": cached_path.as_posix(), "duration": round(time.perf_counter() - start, 6)})
+            except Exception as e:
+                emit({"event": "texture", "path": relative_path, "status": "error", "message": str(e), "duration": round(time.perf_counter() - start, 6)})
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_prefetching()
@@ -2,128 +2,180 @@ import argparse
 from pathlib import Path
 
 from patch import create_patch, create_patched, filter_image
-from difference import compare_image, compare_pack, reverse_original
-from test import test_patch
+from difference import compare_image, compare_pack, difference_image_path, reverse_original, reverse_original_image, difference_stats, reverse_pack
+from test import test_patch, test_patch_pack
 from pack import create_texture_pack, create_texture_patch_pack
 from filters import FITLER_NAMES
 from postprocess import run_command, create_texture_processed_pack
+from watch import watch_texture_patch_pack, watch_texture_pack
+from progress import PROGRESS_MODES
+from memory import BYTES_IN_MEGABYTE
+from deduplicate import DEDUPLICATE_MODES
+from metadata import is_stream, read_image
+from inspection import inspect_patch, inspect_patch_pack
+from lazy import serve_patched_pack, CACHE_MEGABYTES
 
 
-def create(original_path: Path, modified_path: Path, patch_path: Path, filter_names: list[str] = [], print_full_path: bool = False, overwrite: bool = False):
-    if not original_path.exists():
+def exists(path: Path) -> bool:
+    return is_stream(path) or path.exists()
+
+
+def is_file(path: Path) -> bool: # "-" is a single image read from stdin or written to stdout
+    return is_stream(path) or path.is_file()
+
+
+def unsupported_watch_options(progress: str, workers: int, memory_budget: int|None, deduplicate: str|None, batch: int) -> list[str]:
+    """
+    Return the options that watching a directory ignores, one image is processed at a time as it changes.
+    """
+    options = {"--progress json": progress != "text", "--workers": workers > 1, "--memory-budget": memory_budget is not None, "--deduplicate": deduplicate is not None, "--batch": batch > 1}
+    return [option for option, is_passed in options.items() if is_passed]
+
+
+def create(original_path: Path, modified_path: Path, patch_path: Path, filter_names: list[str] = [], print_full_path: bool = False, overwrite: bool = False, threads: int = 1, watch: bool = False, progress: str = "text", workers: int = 1, memory_budget: int|None = None, deduplicate: str|None = None, batch: int = 1):
+    if not exists(original_path):
         print(original_path, "does not exist")
-    elif not modified_path.exists():
+    elif not exists(modified_path):
         print(modified_path, "does not exist")
-    elif original_path == patch_path:
+    elif is_stream(original_path) and is_stream(modified_path):
+        print("Only one image can be read from stdin")
+    elif original_path == patch_path and not is_stream(patch_path):
         print(original_path, "will be overwritten because the same path is provided")
-    elif modified_path == patch_path:
+    elif modified_path == patch_path and not is_stream(patch_path):
         print(modified_path, "will be overwritten because the same path is provided")
-    elif original_path.is_file() and modified_path.is_file():
-        if patch_path.exists() and not overwrite:
+    elif is_file(original_path) and is_file(modified_path):
+        if watch:
+            print("Watching is only supported for directories")
+        elif not is_stream(patch_path) and patch_path.exists() and not overwrite:
             print("Not allowed to overwrite patch image, pass --overwrite")
         else:
-            create_patch(original_path, modified_path, patch_path, filter_names)
+            create_patch(original_path, modified_path, patch_path, filter_names, threads)
+    elif original_path.is_dir() and modified_path.is_dir() and watch:
+        if unsupported := unsupported_watch_options(progress, workers, memory_budget, deduplicate, batch):
+            print(", ".join(unsupported), "not supported for watching yet")
+        else:
+            watch_texture_patch_pack(original_path, modified_path, patch_path, filter_names, print_full_path, threads)
     elif original_path.is_dir() and modified_path.is_dir():
-        create_texture_patch_pack(original_path, modified_path, patch_path, filter_names, print_full_path)
+        create_texture_patch_pack(original_path, modified_path, patch_path, filter_names, print_full_path, threads=threads, progress=progress, workers=workers, memory_budget=memory_budget, deduplicate=deduplicate, batch=batch)
     else:
         print("Expected either all directories or all images")
         print(original_path, "is a", "file" if original_path.is_file() else "", "directory" if original_path.is_dir() else "")
         print(modified_path, "is a", "file" if modified_path.is_file() else "", "directory" if modified_path.is_dir() else "")
 
 
-def apply(original_path: Path, patch_path: Path, patched_path: Path, valide_path: Path|None, filter_names: list[str] = [], print_full_path: bool = False, overwrite: bool = False):
-    if not original_path.exists():
+def apply(original_path: Path, patch_path: Path, patched_path: Path, valide_path: Path|None, filter_names: list[str] = [], print_full_path: bool = False, overwrite: bool = False, threads: int = 1, watch: bool = False, progress: str = "text", workers: int = 1, memory_budget: int|None = None, deduplicate: str|None = None, batch: int = 1):
+    if not exists(original_path):
         print(original_path, "does not exist")
-    elif not patch_path.exists():
+    elif not exists(patch_path):
         print(patch_path, "does not exist")
+    elif is_stream(original_path) and is_stream(patch_path):
+        print("Only one image can be read from stdin")
     elif valide_path and not valide_path.exists():
         print(valide_path, "does not exist")
-    elif original_path == patched_path:
+    elif original_path == patched_path and not is_stream(patched_path):
         print(original_path, "will be overwritten because the same path is provided")
-    elif patch_path == patched_path:
+    elif patch_path == patched_path and not is_stream(patched_path):
         print(patch_path, "will be overwritten because the same path is provided")
-    elif original_path.is_file() and patch_path.is_file():
+    elif is_file(original_path) and is_file(patch_path):
         if valide_path:
             print("compare not setup for single images yet")
-        elif patched_path.exists() and not overwrite:
+        elif watch:
+            print("Watching is only supported for directories")
+        elif not is_stream(patched_path) and patched_path.exists() and not overwrite:
             print("Not allowed to overwrite patched image, pass --overwrite")
         else:
-            create_patched(original_path, patch_path, patched_path, filter_names)
+            create_patched(original_path, patch_path, patched_path, filter_names, threads)
+    elif original_path.is_dir() and patch_path.is_dir() and watch:
+        if valide_path:
+            print("validate not setup for watching yet")
+        elif unsupported := unsupported_watch_options(progress, workers, memory_budget, deduplicate, batch):
+            print(", ".join(unsupported), "not supported for watching yet")
+        else:
+            watch_texture_pack(original_path, patch_path, patched_path, filter_names, print_full_path, threads)
     elif original_path.is_dir() and patch_path.is_dir():
-        create_texture_pack(original_path, patch_path, patched_path, valide_path, filter_names, print_full_path)
+        create_texture_pack(original_path, patch_path, patched_path, valide_path, filter_names, print_full_path, threads=threads, progress=progress, workers=workers, memory_budget=memory_budget, deduplicate=deduplicate, batch=batch)
     else:
         print("Expected either all directories or all images")
         print(original_path, "is a", "file" if original_path.is_file() else "", "directory" if original_path.is_dir() else "")
         print(patch_path,    "is a", "file" if patch_path.is_file() else "",    "directory" if patch_path.is_dir() else "")
 
 
-def diff(reference_path: Path, patched_path: Path, difference_path: Path|None, print_full_path: bool = False, overwrite: bool = False):
+def diff(reference_path: Path, patched_path: Path, difference_path: Path|None, print_full_path: bool = False, overwrite: bool = False, progress: str = "text"):
     if not reference_path.exists():
         print(reference_path, "does not exist")
     elif not patched_path.exists():
         print(patched_path, "does not exist")
     elif reference_path.is_file() and patched_path.is_file():
-        if difference_path and difference_path.exists() and not overwrite:
+        if difference_path and difference_image_path(difference_path, reference_path, patched_path).exists() and not overwrite:
             print("Not allowed to overwrite difference image, pass --overwrite")
         else:
             print(compare_image(reference_path, patched_path, difference_path))
     elif reference_path.is_dir() and patched_path.is_dir():
-        compare_pack(reference_path, patched_path, difference_path, print_full_path)
+        compare_pack(reference_path, patched_path, difference_path, print_full_path, overwrite, progress)
     else:
         print("Expected either all directories or all images")
         print(reference_path, "is a", "file" if reference_path.is_file() else "", "directory" if reference_path.is_dir() else "")
         print(patched_path,   "is a", "file" if patched_path.is_file() else "",   "directory" if patched_path.is_dir() else "")
 
 
-def reverse(modified_path: Path, patch_path: Path, reversed_path: Path|None):
+def reverse(modified_path: Path, patch_path: Path, reversed_path: Path|None, original_path: Path|None = None, print_full_path: bool = False, overwrite: bool = False, threads: int = 1, progress: str = "text", workers: int = 1, memory_budget: int|None = None):
     if not modified_path.exists():
         print(modified_path, "does not exist")
     elif not patch_path.exists():
         print(patch_path, "does not exist")
-    elif modified_path == patched_path:
+    elif original_path and not original_path.exists():
+        print(original_path, "does not exist")
+    elif reversed_path is None and original_path is None:
+        print("Expected a reversed path to write to, or an original path to compare with")
+    elif modified_path == reversed_path:
         print(modified_path, "will be overwritten because the same path is provided")
-    elif patch_path == patched_path:
+    elif patch_path == reversed_path:
         print(patch_path, "will be overwritten because the same path is provided")
     elif modified_path.is_file() and patch_path.is_file():
-        reverse_original(modified_path, patch_path, reversed_path)
+        if reversed_path:
+            reverse_original(modified_path, patch_path, reversed_path)
+        if original_path:
+            stats = difference_stats(read_image(original_path), reverse_original_image(read_image(modified_path), read_image(patch_path), threads), threads)
+            print("reversed difference:", stats["difference"], "mean:", stats["mean"], f"recovered: {stats['recovered']:.2%}")
     elif modified_path.is_dir() and patch_path.is_dir():
-        print("Directory reversing not implemented yet")
-        pass
+        reverse_pack(modified_path, patch_path, reversed_path, original_path, print_full_path, overwrite, threads, progress, workers, memory_budget)
     else:
         print("Expected either all directories or all images")
         print(modified_path, "is a", "file" if modified_path.is_file() else "", "directory" if modified_path.is_dir() else "")
         print(patch_path,    "is a", "file" if patch_path.is_file() else "",    "directory" if patch_path.is_dir() else "")
 
 
-def test(original_path: Path, modified_path: Path):
+def test(original_path: Path, modified_path: Path, filter_names: list[str] = [], print_full_path: bool = False, threads: int = 1, progress: str = "text", workers: int = 1, memory_budget: int|None = None):
     if not original_path.exists():
         print(original_path, "does not exist")
     elif not modified_path.exists():
         print(modified_path, "does not exist")
     elif original_path.is_file() and modified_path.is_file():
-        test_patch(original_path, modified_path)
+        test_patch(original_path, modified_path, filter_names)
     elif original_path.is_dir() and modified_path.is_dir():
-        pass
+        test_patch_pack(original_path, modified_path, filter_names, print_full_path, threads, progress, workers, memory_budget)
     else:
         print("Expected either all directories or all images")
         print(original_path, "is a", "file" if original_path.is_file() else "", "directory" if original_path.is_dir() else "")
         print(modified_path, "is a", "file" if modified_path.is_file() else "", "directory" if modified_path.is_dir() else "")
 
 
-def test_filter(image_path: Path, filtered_path: Path, fitler_names: list[str], seed_image_path: Path|None, inverted: bool = False):
+def test_filter(image_path: Path, filtered_path: Path, fitler_names: list[str], seed_image_path: Path|None, inverted: bool = False, threads: int = 1):
     seed_image_path_ = seed_image_path if seed_image_path else image_path
     if not seed_image_path and inverted:
         print("warning: inverting filters while no seed provided. Are you sure you want to use the first path as seed? Ensure the same seed is used as when the filters were applied.")
-    if not image_path.exists():
+    if not exists(image_path):
         print(image_path, "does not exist")
-    elif not filtered_path.exists():
+    elif not exists(filtered_path):
         print(filtered_path, "does not exist")
-    elif not seed_image_path.exists():
-        print(seed_image_path, "does not exist")
-    elif image_path == filtered_path:
+    elif not exists(seed_image_path_):
+        print(seed_image_path_, "does not exist")
+    elif is_stream(image_path) and is_stream(seed_image_path_) and seed_image_path_ != image_path:
+        print("Only one image can be read from stdin")
+    elif image_path == filtered_path and not is_stream(filtered_path):
         print(filtered_path, "will be overwritten because the same path is provided")
-    elif image_path.is_file() and filtered_path.is_file():
-        filter_image(image_path, filtered_path, seed_image_path_, fitler_names, inverted)
+    elif is_file(image_path) and is_file(filtered_path):
+        filter_image(image_path, filtered_path, seed_image_path_, fitler_names, inverted, threads)
     elif image_path.is_dir() and filtered_path.is_dir():
         print("Directory reversing not implemented yet")
         pass
@@ -133,7 +185,30 @@ def test_filter(image_path: Path, filtered_path: Path, fitler_names: list[str],
         print(filtered_path, "is a", "file" if filtered_path.is_file() else "", "directory" if filtered_path.is_dir() else "")
 
 
-def process(command_template: str, original_path: Path, processed_path: Path, original_placeholder: str, processed_placeholder: str, print_full_path: bool = False, overwrite: bool = False):
+def inspect(patch_path: Path, print_full_path: bool = False, as_json: bool = False):
+    if not patch_path.exists():
+        print(patch_path, "does not exist")
+    elif patch_path.is_file():
+        inspect_patch(patch_path, as_json)
+    else:
+        inspect_patch_pack(patch_path, print_full_path, as_json)
+
+
+def serve(original_path: Path, patch_path: Path, cache_path: Path, filter_names: list[str] = [], threads: int = 1, cache_size: int = CACHE_MEGABYTES, prefetch_list_path: Path|None = None):
+    if not original_path.is_dir():
+        print(original_path, "is not a directory")
+    elif not patch_path.is_dir():
+        print(patch_path, "is not a directory")
+    elif prefetch_list_path and not prefetch_list_path.is_file():
+        print(prefetch_list_path, "does not exist")
+    elif cache_path in [original_path, patch_path]:
+        print(cache_path, "would mix patched textures with the originals or patches")
+    else:
+        prefetch_paths = [line.strip() for line in prefetch_list_path.read_text().splitlines() if line.strip()] if prefetch_list_path else []
+        serve_patched_pack(original_path, patch_path, cache_path, filter_names, cache_size * BYTES_IN_MEGABYTE, threads, prefetch_paths)
+
+
+def process(command_template: str, original_path: Path, processed_path: Path, original_placeholder: str, processed_placeholder: str, print_full_path: bool = False, overwrite: bool = False, progress: str = "text"):
     if not original_path.exists():
         print(original_path, "does not exist")
     elif original_placeholder not in command_template:
@@ -146,7 +221,7 @@ def process(command_template: str, original_path: Path, processed_path: Path, or
         else:
             run_command(command_template, original_path, processed_path, original_placeholder, processed_placeholder)
     elif original_path.is_dir():
-        create_texture_processed_pack(command_template, original_path, processed_path, original_placeholder, processed_placeholder, print_full_path)
+        create_texture_processed_pack(command_template, original_path, processed_path, original_placeholder, processed_placeholder, print_full_path, progress=progress)
     else:
         print("Hm, this is impossible")
 
@@ -157,25 +232,39 @@ def main():
     
     create_parser = subparsers.add_parser("create", help="Create a patch")
     create_parser.add_argument(dest="original_path",                   metavar="original-path", type=Path, # "-i", "--input", default=".",
-        help="The path to the original directory or image")
+        help="The path to the original directory or image, - for stdin")
     create_parser.add_argument(dest="modified_path",                   metavar="modified-path", type=Path, # "-m", "--modified", default=DEFAULT_OUTPUT_PATH,
-        help="The path to the modified directory or image")
+        help="The path to the modified directory or image, - for stdin")
     create_parser.add_argument(dest="patch_path",                      metavar="patch-path",    type=Path, # "-o", "--output", default=DEFAULT_OUTPUT_PATH,
-        help="The path to the directory containing patch images or patch image")
+        help="The path to the directory containing patch images or patch image, - for a png on stdout")
     create_parser.add_argument("-f", "--filters", dest="filter_names", metavar="filters-names", type=str, nargs="+", choices=FITLER_NAMES, default=[],
         help="The names of the filters to apply")
     create_parser.add_argument("--print-full-path", dest="print_full_path", action="store_true",
         help="Print full paths when processing an image in a directory")
     create_parser.add_argument("--overwrite", dest="overwrite", action="store_true",
         help="Overwrite the patch image if it exists")
+    create_parser.add_argument("-j", "--threads", dest="threads", metavar="threads", type=int, default=1,
+        help="The number of threads to split the rows of a single image over")
+    create_parser.add_argument("--watch", dest="watch", action="store_true",
+        help="Keep running and recreate the patches of new or changed modified images in a directory")
+    create_parser.add_argument("--progress", dest="progress", metavar="mode", type=str, choices=PROGRESS_MODES, default="text",
+        help="Print the progress of a directory as colored text or as one json event per line")
+    create_parser.add_argument("-w", "--workers", dest="workers", metavar="workers", type=int, default=1,
+        help="The number of images of a directory to process at the same time, largest first")
+    create_parser.add_argument("--memory-budget", dest="memory_budget", metavar="megabytes", type=int, default=None,
+        help="Only start another image of a directory while the estimated memory of all running images fits")
+    create_parser.add_argument("--deduplicate", dest="deduplicate", metavar="mode", type=str, choices=DEDUPLICATE_MODES, default=None,
+        help="Compute images of a directory with identical inputs once, and hardlink or copy the result to the duplicates")
+    create_parser.add_argument("-b", "--batch", dest="batch", metavar="images", type=int, default=1,
+        help="Stack up to this number of small images of a directory with the same shape into one array")
 
     apply_parser = subparsers.add_parser("apply", help="Apply a patch")
     apply_parser.add_argument(dest="original_path",                    metavar="original-path", type=Path, # "-i", "--input", default=".",
-        help="The path to the original directory or image")
+        help="The path to the original directory or image, - for stdin")
     apply_parser.add_argument(dest="patch_path",                       metavar="patch-path",    type=Path, # "-o", "--patch", default=DEFAULT_OUTPUT_PATH,
-        help="The path to the patch directory or image")
+        help="The path to the patch directory or image, - for stdin")
     apply_parser.add_argument(dest="patched_path",                     metavar="patched-path",  type=Path, # "-m", "--output", default=DEFAULT_OUTPUT_PATH,
-        help="The path to the directory containing patched images or patched image")
+        help="The path to the directory containing patched images or patched image, - for a png on stdout")
     apply_parser.add_argument("-v", "--validate", dest="validate_path", metavar="validate-path", type=Path,
         help="Validate the patched path result with another path's content")
     apply_parser.add_argument("-f", "--filters", dest="filter_names",  metavar="filters-names", type=str, nargs="+", choices=FITLER_NAMES, default=[],
@@ -184,6 +273,20 @@ def main():
         help="Print full paths when processing an image in a directory")
     apply_parser.add_argument("--overwrite", dest="overwrite", action="store_true",
         help="Overwrite the patched image if it exists")
+    apply_parser.add_argument("-j", "--threads", dest="threads", metavar="threads", type=int, default=1,
+        help="The number of threads to split the rows of a single image over")
+    apply_parser.add_argument("--watch", dest="watch", action="store_true",
+        help="Keep running and reapply new or changed patches in a directory")
+    apply_parser.add_argument("--progress", dest="progress", metavar="mode", type=str, choices=PROGRESS_MODES, default="text",
+        help="Print the progress of a directory as colored text or as one json event per line")
+    apply_parser.add_argument("-w", "--workers", dest="workers", metavar="workers", type=int, default=1,
+        help="The number of images of a directory to process at the same time, largest first")
+    apply_parser.add_argument("--memory-budget", dest="memory_budget", metavar="megabytes", type=int, default=None,
+        help="Only start another image of a directory while the estimated memory of all running images fits")
+    apply_parser.add_argument("--deduplicate", dest="deduplicate", metavar="mode", type=str, choices=DEDUPLICATE_MODES, default=None,
+        help="Compute images of a directory with identical inputs once, and hardlink or copy the result to the duplicates")
+    apply_parser.add_argument("-b", "--batch", dest="batch", metavar="images", type=int, default=1,
+        help="Stack up to this number of small images of a directory with the same shape into one array")
     # -r --max-depth x
 
     diff_parser = subparsers.add_parser("diff", help="Compare a reference image with a modified one")
@@ -197,37 +300,89 @@ def main():
         help="Print full paths when processing an image in a directory")
     diff_parser.add_argument("--overwrite", dest="overwrite", action="store_true",
         help="Overwrite the reversed image if it exists")
+    diff_parser.add_argument("--progress", dest="progress", metavar="mode", type=str, choices=PROGRESS_MODES, default="text",
+        help="Print the progress of a directory as colored text or as one json event per line")
 
     reverse_parser = subparsers.add_parser("reverse", help="Reverse the original image by a patch")
     reverse_parser.add_argument(dest="modified_path",                  metavar="modified-path",   type=Path, # "-m", "--modified", default=DEFAULT_OUTPUT_PATH,
         help="The path to the modified directory or image")
     reverse_parser.add_argument(dest="patch_path",                     metavar="patch-path",      type=Path, # "-o", "--output", default=DEFAULT_OUTPUT_PATH,
         help="The path to the patch directory or image")
-    reverse_parser.add_argument(dest="reversed_path",                  metavar="reversed-path",   type=Path, # "-i", "--input", default=".",
-        help="The path to the directory containing reversed images or reversed image")
+    reverse_parser.add_argument(dest="reversed_path",                  metavar="reversed-path",   type=Path, nargs="?", default=None, # "-i", "--input", default=".",
+        help="The path to the directory containing reversed images or reversed image, omit to only compare with --original")
+    reverse_parser.add_argument("--original", dest="original_path",    metavar="original-path",   type=Path, default=None,
+        help="Compare every reversed image with the original directory or image, instead of only writing it")
+    reverse_parser.add_argument("--print-full-path", dest="print_full_path", action="store_true",
+        help="Print full paths when processing an image in a directory")
     reverse_parser.add_argument("--overwrite", dest="overwrite", action="store_true",
-        help="Overwrite the processed image if it exists")
+        help="Overwrite the reversed image if it exists")
+    reverse_parser.add_argument("-j", "--threads", dest="threads", metavar="threads", type=int, default=1,
+        help="The number of threads to split the rows of a single image over")
+    reverse_parser.add_argument("--progress", dest="progress", metavar="mode", type=str, choices=PROGRESS_MODES, default="text",
+        help="Print the progress of a directory as colored text or as one json event per line")
+    reverse_parser.add_argument("-w", "--workers", dest="workers", metavar="workers", type=int, default=1,
+        help="The number of images of a directory to process at the same time, largest first")
+    reverse_parser.add_argument("--memory-budget", dest="memory_budget", metavar="megabytes", type=int, default=None,
+        help="Only start another image of a directory while the estimated memory of all running images fits")
 
     test_parser = subparsers.add_parser("test", help="Run all modes on an original and its modified image")
     test_parser.add_argument(dest="original_path",                     metavar="original-path",   type=Path, # "-i", "--input", default=".",
         help="The path to the original directory or image")
     test_parser.add_argument(dest="modified_path",                     metavar="modified-path",   type=Path, # "-m", "--modified", default=DEFAULT_OUTPUT_PATH,
         help="The path to the modified directory or image")
+    test_parser.add_argument("-f", "--filters", dest="filter_names",   metavar="filters-names", type=str, nargs="+", choices=FITLER_NAMES, default=[],
+        help="The names of the filters to apply and invert")
+    test_parser.add_argument("--print-full-path", dest="print_full_path", action="store_true",
+        help="Print full paths when testing an image in a directory")
+    test_parser.add_argument("-j", "--threads", dest="threads", metavar="threads", type=int, default=1,
+        help="The number of threads to split the rows of a single image over")
+    test_parser.add_argument("--progress", dest="progress", metavar="mode", type=str, choices=PROGRESS_MODES, default="text",
+        help="Print the results of a directory as colored text or as one json event per line")
+    test_parser.add_argument("-w", "--workers", dest="workers", metavar="workers", type=int, default=1,
+        help="The number of images of a directory to test at the same time, largest first")
+    test_parser.add_argument("--memory-budget", dest="memory_budget", metavar="megabytes", type=int, default=None,
+        help="Only start another image of a directory while the estimated memory of all running images fits")
 
     filter_parser = subparsers.add_parser("test-filter", help="Test filters on a patch or regular image")
     filter_parser.add_argument(dest="image_path",                      metavar="image-path",      type=Path, # "-i", "--input", default=".",
-        help="The path to the directory of images or image")
+        help="The path to the directory of images or image, - for stdin")
     filter_parser.add_argument(dest="filtered_path",                   metavar="filtered-path",   type=Path, # "-m", "--modified", default=DEFAULT_OUTPUT_PATH,
-        help="The path to the filtered directory or image")
+        help="The path to the filtered directory or image, - for a png on stdout")
     filter_parser.add_argument(dest="filter_names",                    metavar="filters",         type=str, nargs="+", choices=FITLER_NAMES,
         help="The names of the filters to apply")
     filter_parser.add_argument("-s", "--seed", dest="seed_image_path", metavar="seed-image-path", type=Path, default=None,
         help="The path to the image that is used as a seed")
     filter_parser.add_argument("-i", "--inverted", dest="inverted",    action="store_true",
         help="Invert the filters and their order")
+    filter_parser.add_argument("-j", "--threads", dest="threads",      metavar="threads", type=int, default=1,
+        help="The number of threads to split the rows of a single image over")
     # filter_parser.add_argument("--show",                  action="store_true",
     #     help="Enable verbose output")
 
+    inspect_parser = subparsers.add_parser("inspect", help="Print the metadata of a patch without decoding it")
+    inspect_parser.add_argument(dest="patch_path",                     metavar="patch-path",      type=Path,
+        help="The path to the patch directory or image")
+    inspect_parser.add_argument("--print-full-path", dest="print_full_path", action="store_true",
+        help="Print full paths when inspecting a patch in a directory")
+    inspect_parser.add_argument("--json", dest="as_json", action="store_true",
+        help="Print the metadata of every patch as one json object per line")
+
+    serve_parser = subparsers.add_parser("serve", help="Apply patches on demand, for texture paths read from stdin")
+    serve_parser.add_argument(dest="original_path",                    metavar="original-path", type=Path,
+        help="The path to the original directory")
+    serve_parser.add_argument(dest="patch_path",                       metavar="patch-path",    type=Path,
+        help="The path to the patch directory")
+    serve_parser.add_argument(dest="cache_path",                       metavar="cache-path",    type=Path,
+        help="The path to the directory to keep the patched textures in")
+    serve_parser.add_argument("-f", "--filters", dest="filter_names",  metavar="filters-names", type=str, nargs="+", choices=FITLER_NAMES, default=[],
+        help="The names of the filters to invert, the ones recorded in the patches by default")
+    serve_parser.add_argument("-j", "--threads", dest="threads", metavar="threads", type=int, default=1,
+        help="The number of threads to split the rows of a single image over")
+    serve_parser.add_argument("--cache-size", dest="cache_size", metavar="megabytes", type=int, default=CACHE_MEGABYTES,
+        help="Remove the least recently used patched textures beyond this size")
+    serve_parser.add_argument("--prefetch", dest="prefetch_list_path", metavar="list-path", type=Path, default=None,
+        help="A file with texture paths that are likely needed next, one per line, to patch in the background")
+
     process_parser = subparsers.add_parser("process", help="Process a generic command on an image or directory")
     process_parser.add_argument(dest="command_template",                            metavar="command-template", type=str, # "-m", "--modified", default=DEFAULT_OUTPUT_PATH,
         help="The command to execute containing placeholder-input and placeholder-output")
@@ -243,18 +398,23 @@ def main():
         help="Print full paths when processing an image in a directory")
     process_parser.add_argument("--overwrite", dest="overwrite", action="store_true",
         help="Overwrite the processed image if it exists")
+    process_parser.add_argument("--progress", dest="progress", metavar="mode", type=str, choices=PROGRESS_MODES, default="text",
+        help="Print the progress of a directory as colored text or as one json event per line")
     
 
     arguments = parser.parse_args()
     command = arguments.subparser_name
+    memory_budget = arguments.memory_budget * BYTES_IN_MEGABYTE if getattr(arguments, "memory_budget", None) else None
     match command:
-        case "create":      create(arguments.original_path, arguments.modified_path, arguments.patch_path, arguments.filter_names, arguments.print_full_path, arguments.overwrite)
-        case "apply":       apply(arguments.original_path, arguments.patch_path, arguments.patched_path, arguments.validate_path, arguments.filter_names, arguments.print_full_path, arguments.overwrite)
-        case "diff":        diff(arguments.reference_path, arguments.modified_path, arguments.difference_path, arguments.print_full_path, arguments.overwrite)
-        case "reverse":     reverse(arguments.modified_path, arguments.patch_path, arguments.reversed_path)
-        case "test":        test(arguments.original_path, arguments.modified_path)
-        case "test-filter": test_filter(arguments.image_path, arguments.filtered_path, arguments.filter_names, arguments.seed_image_path, arguments.inverted)
-        case "process":     process(arguments.command_template, arguments.image_path, arguments.processed_path, arguments.original_placeholder, arguments.processed_placeholder, arguments.print_full_path, arguments.overwrite)
+        case "create":      create(arguments.original_path, arguments.modified_path, arguments.patch_path, arguments.filter_names, arguments.print_full_path, arguments.overwrite, arguments.threads, arguments.watch, arguments.progress, arguments.workers, memory_budget, arguments.deduplicate, arguments.batch)
+        case "apply":       apply(arguments.original_path, arguments.patch_path, arguments.patched_path, arguments.validate_path, arguments.filter_names, arguments.print_full_path, arguments.overwrite, arguments.threads, arguments.watch, arguments.progress, arguments.workers, memory_budget, arguments.deduplicate, arguments.batch)
+        case "diff":        diff(arguments.reference_path, arguments.modified_path, arguments.difference_path, arguments.print_full_path, arguments.overwrite, arguments.progress)
+        case "reverse":     reverse(arguments.modified_path, arguments.patch_path, arguments.reversed_path, arguments.original_path, arguments.print_full_path, arguments.overwrite, arguments.threads, arguments.progress, arguments.workers, memory_budget)
+        case "test":        test(arguments.original_path, arguments.modified_path, arguments.filter_names, arguments.print_full_path, arguments.threads, arguments.progress, arguments.workers, memory_budget)
+        case "test-filter": test_filter(arguments.image_path, arguments.filtered_path, arguments.filter_names, arguments.seed_image_path, arguments.inverted, arguments.threads)
+        case "inspect":     inspect(arguments.patch_path, arguments.print_full_path, arguments.as_json)
+        case "serve":       serve(arguments.original_path, arguments.patch_path, arguments.cache_path, arguments.filter_names, arguments.threads, arguments.cache_size, arguments.prefetch_list_path)
+        case "process":     process(arguments.command_template, arguments.image_path, arguments.processed_path, arguments.original_placeholder, arguments.processed_placeholder, arguments.print_full_path, arguments.overwrite, arguments.progress)
         case _:             parser.print_help()
 
 
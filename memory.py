@@ -0,0 +1,83 @@
+import struct
+import cv2
+import numpy as np
+from pathlib import Path
+
+from metadata import read_metadata
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 4, 6: 4} # color type -> channels as decoded by cv2.IMREAD_UNCHANGED
+JPEG_START_OF_FRAMES = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+BOOLEANS_IN_BYTE = 8
+BYTES_IN_MEGABYTE = 1_000_000
+# measured peak of create_patch_image and create_patched_image per element of the modified image,
+# on top of the decoded original: ~11 bytes for 8 bit and ~19.5 bytes for 16 bit images
+ESTIMATED_BYTES_PER_ITEM = 8
+ESTIMATED_BYTES_PER_ELEMENT = 4
+# the stacked create_patch_images and create_patched_images are not split into bands: ~25 bytes for 8 bit and ~38 bytes for 16 bit images
+ESTIMATED_STACKED_BYTES_PER_ITEM = 13
+ESTIMATED_STACKED_BYTES_PER_ELEMENT = 12
+# the pipeline also holds the images read ahead and waiting to be written: measured ~1.7 times the estimate of the image computed
+ESTIMATED_PIPELINE_FACTOR = 2
+
+
+def read_png_header(path: Path) -> tuple[int, int, int, int]:
+    with open(path, "rb") as file:
+        header = file.read(26)
+    if len(header) < 26 or header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        raise ValueError("Not a png image")
+    width, height, bit_depth, color_type = struct.unpack(">IIBB", header[16:26])
+    return height, width, PNG_CHANNELS.get(color_type, 4), 2 if bit_depth == 16 else 1
+
+
+def read_jpeg_header(path: Path) -> tuple[int, int, int, int]:
+    with open(path, "rb") as file:
+        if file.read(2) != b"\xff\xd8":
+            raise ValueError("Not a jpeg image")
+        while (marker := file.read(2)) and marker[0] == 0xFF:
+            length, = struct.unpack(">H", file.read(2))
+            if marker[1] in JPEG_START_OF_FRAMES:
+                _, height, width, components = struct.unpack(">BHHB", file.read(6))
+                return height, width, components, 1
+            file.seek(length - 2, 1)
+    raise ValueError("No frame found in jpeg image")
+
+
+def read_image_shape(path: Path) -> tuple[int, int, int, int]:
+    """
+    Return (height, width, channels, bytes per channel) by reading only the header of png and jpeg images.
+    Other formats are fully decoded.
+    """
+    try:
+        return read_png_header(path)
+    except ValueError:
+        pass
+    try:
+        return read_jpeg_header(path)
+    except (ValueError, struct.error):
+        pass
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Could not read {path.name}")
+    height, width = image.shape[:2]
+    return height, width, image.shape[2] if image.ndim > 2 else 1, image.dtype.itemsize
+
+
+def estimate_memory(original_path: Path, image_path: Path, is_patch: bool = False, is_stacked: bool = False) -> int:
+    """
+    Estimate the peak memory in bytes to create a patch from (or apply a patch on) an original image, on its own or as part of a stack.
+    Unreadable images are estimated at 0, they will fail quickly anyway.
+    """
+    try:
+        original_height, original_width, original_channels, _ = read_image_shape(original_path)
+        height, width, channels, itemsize = read_image_shape(image_path)
+    except (OSError, ValueError):
+        return 0
+    elements = height * width * channels
+    if is_patch and (shape := read_metadata(image_path).get("shape")): # the shape of the patched image
+        elements = int(np.prod(shape))
+    elif is_patch: # the patch also holds two maps of one bit per element
+        elements = int(elements / (1 + 2 / (BOOLEANS_IN_BYTE * itemsize)))
+    bytes_per_item, bytes_per_element = (ESTIMATED_STACKED_BYTES_PER_ITEM, ESTIMATED_STACKED_BYTES_PER_ELEMENT) if is_stacked else (ESTIMATED_BYTES_PER_ITEM, ESTIMATED_BYTES_PER_ELEMENT)
+    return elements * (bytes_per_item * itemsize + bytes_per_element) + original_height * original_width * original_channels * itemsize
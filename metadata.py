@@ -0,0 +1,124 @@
+import hashlib
+import json
+import struct
+import sys
+import zlib
+import cv2
+import numpy as np
+from pathlib import Path
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_HEADER_SIZE = len(PNG_SIGNATURE) + 4 + 4 + 13 + 4 # signature and IHDR chunk (length, type, data, crc)
+METADATA_KEYWORD = b"TexturePatch"
+CHECKSUM_SIZE = 16 # bytes
+STREAM_PATH = Path("-") # read from stdin or write to stdout
+
+
+def is_stream(path: Path) -> bool:
+    return path == STREAM_PATH
+
+
+def image_checksum(image: np.ndarray) -> str:
+    """
+    Hash the shape, type and pixels of an image in a single pass.
+    """
+    checksum = hashlib.blake2b(digest_size=CHECKSUM_SIZE)
+    checksum.update(f"{image.shape}{image.dtype.str}".encode())
+    checksum.update(np.ascontiguousarray(image).data)
+    return checksum.hexdigest()
+
+
+def create_png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def encode_png(image: np.ndarray, metadata: dict) -> bytes:
+    """
+    Encode a png like cv2.imwrite does, with the metadata as json in a tEXt chunk right after the header.
+    """
+    is_encoded, buffer = cv2.imencode(".png", image)
+    if not is_encoded:
+        raise ValueError("Could not encode image as png")
+    encoded = buffer.tobytes()
+    chunk = create_png_chunk(b"tEXt", METADATA_KEYWORD + b"\0" + json.dumps(metadata, sort_keys=True).encode("latin-1"))
+    return encoded[:PNG_HEADER_SIZE] + chunk + encoded[PNG_HEADER_SIZE:]
+
+
+def write_image(path: Path, image: np.ndarray, metadata: dict|None = None) -> None:
+    """
+    Write the image with its metadata, other formats than png are written without it.
+    The stream path writes a png to stdout.
+    """
+    if is_stream(path):
+        if metadata is not None:
+            encoded = encode_png(image, metadata)
+        else:
+            is_encoded, buffer = cv2.imencode(".png", image)
+            if not is_encoded:
+                raise ValueError("Could not encode image as png")
+            encoded = buffer.tobytes()
+        sys.stdout.buffer.write(encoded)
+        sys.stdout.buffer.flush()
+    elif metadata is None or path.suffix.lower() != ".png":
+        cv2.imwrite(path, image)
+    else:
+        path.write_bytes(encode_png(image, metadata))
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError("Could not decode image")
+    return image
+
+
+def read_image(path: Path) -> np.ndarray:
+    """
+    Read an image unchanged, the stream path decodes it from stdin.
+    """
+    if is_stream(path):
+        return decode_image(sys.stdin.buffer.read())
+    return cv2.imread(path, cv2.IMREAD_UNCHANGED)
+
+
+def read_image_and_metadata(path: Path) -> tuple[np.ndarray, dict]:
+    """
+    Read an image unchanged with its metadata, stdin can only be read once.
+    """
+    if is_stream(path):
+        data = sys.stdin.buffer.read()
+        return decode_image(data), parse_metadata(data)
+    return cv2.imread(path, cv2.IMREAD_UNCHANGED), read_metadata(path)
+
+
+def parse_metadata(data: bytes) -> dict:
+    """
+    Read the metadata from the chunks of an (incomplete) png, without decoding any pixels.
+    Images without metadata, e.g. older patches or patches stripped by an optimizer, return an empty dict.
+    """
+    if data[:len(PNG_SIGNATURE)] != PNG_SIGNATURE:
+        return {}
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[offset:offset + 8])
+        if chunk_type in [b"IDAT", b"IEND"]:
+            break
+        chunk_data = data[offset + 8:offset + 8 + length]
+        if chunk_type == b"tEXt" and chunk_data.startswith(METADATA_KEYWORD + b"\0"):
+            return json.loads(chunk_data[len(METADATA_KEYWORD) + 1:].decode("latin-1"))
+        offset += 8 + length + 4
+    return {}
+
+
+def read_metadata(path: Path) -> dict:
+    """
+    Read the metadata of an image, reading the file chunk by chunk up to the pixel data.
+    """
+    data = b""
+    with open(path, "rb") as file:
+        while chunk := file.read(4096):
+            data += chunk
+            if b"IDAT" in data or b"IEND" in data:
+                break
+    return parse_metadata(data)
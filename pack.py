@@ -1,90 +1,263 @@
+import time
+import numpy as np
 from pathlib import Path
-from patch import create_patch, create_patched
+from typing import Callable
+from patch import create_patch, create_patched, create_patch_image, create_patched_image, create_patch_batch, create_patched_batch, patch_metadata, recorded_filter_names
 from difference import compare_image
 from cli import RESET, RED, GREEN, ORANGE, BLUE, MAGENTA, CYAN, BOLD
 from traverse import check_out_path, print_indented
+from progress import create_json_reporter, count_images, silent
+from parallel import run_pipeline, returned, create_ordered_runner
+from memory import estimate_memory, read_image_shape, ESTIMATED_PIPELINE_FACTOR
+from deduplicate import pair_key, link_duplicate, unlink_shared
+from metadata import write_image, read_image, read_image_and_metadata
 
 
 SUFFIXES = [".png"]
+BATCH_MAX_ELEMENTS = 256 * 256 * 4 # larger images spend their time in numpy already, stacking them gains nothing
 
 
-def create_texture_patch_pack(original_path: Path, modified_path: Path, patch_path: Path, filter_names: list[str] = [], print_full_path: bool = False, overwrite: bool = False) -> None:
+def small_image_shape(path: Path) -> tuple[int, int, int, int]|None:
+    """
+    Return the shape of an image that is small enough to be stacked with others of the same shape, None otherwise.
+    """
+    try:
+        height, width, channels, itemsize = read_image_shape(path)
+    except (OSError, ValueError):
+        return None
+    return (height, width, channels, itemsize) if height * width * channels <= BATCH_MAX_ELEMENTS else None
+
+
+def run_pack(source_path: Path, output_path: Path, original_path: Path, is_job: Callable[[Path], bool], callback_dir: Callable[..., None], callback_file: Callable[..., None], key_of: Callable[[Path, Path], str], read: Callable[[Path, Path], tuple], compute: Callable[..., tuple], compute_batch: Callable[[list[Path], list[Path]], list[tuple]], estimate: Callable[[Path, Path, bool], int], run_ordered: Callable[..., None], progress: str = "text", overwrite: bool = False, workers: int = 1, memory_budget: int|None = None, deduplicate: str|None = None, batch: int = 1) -> None:
+    """
+    Call callback_file for every image of the source directory, shared by create and apply.
+    With one worker, reading, computing and writing are pipelined, the computed result is written by passing its write to callback_file.
+    Otherwise, the jobs are admitted by memory on a thread pool, and small images of the same shape are stacked into batches.
+    Duplicates are only linked after their first occurrence has been written.
+    """
+    jobs, duplicates = [], []
+    batches: dict[tuple, list[tuple[Path, int]]] = {} # shape -> small images to stack
+    events: list[tuple[Callable[[Path, int], None], Path, int, bool]] = [] # (callback, path, level, is read ahead) in traversal order
+    collected: set[str] = set() # content keys of the jobs computed
+    spent: dict[Path, float] = {} # path -> seconds spent by the read and compute stages of the pipeline
+    largest = 0 # estimated memory of the largest image read ahead, against the budget
+    def original_of(path: Path) -> Path:
+        return original_path.joinpath(path.relative_to(source_path))
+    def is_pending(path: Path) -> bool: # its output still has to be computed
+        return original_of(path).exists() and (overwrite or not output_path.joinpath(path.relative_to(source_path)).exists())
+    def writer(result: Callable[[], tuple]) -> Callable[..., None]: # in place of create_patch or create_patched
+        return lambda _original_path, _source_path, image_output_path, *_: write_image(image_output_path, *result())
+    def collect_file(path: Path, level: int):
+        if deduplicate and original_of(path).exists():
+            if (key := key_of(original_of(path), path)) in collected:
+                duplicates.append((path, level))
+                return
+            collected.add(key)
+        if batch > 1 and is_pending(path):
+            if shape := small_image_shape(path):
+                batches.setdefault(shape, []).append((path, level))
+                return
+        jobs.append((estimate(original_of(path), path, False), lambda: callback_file(path, level)))
+    def callback_batch(files: list[tuple[Path, int]]):
+        start = time.perf_counter()
+        try:
+            results = compute_batch([original_of(path) for path, _ in files], [path for path, _ in files])
+        except Exception: # one by one, to report the error of each image
+            for path, level in files:
+                callback_file(path, level)
+            return
+        share = (time.perf_counter() - start) / len(files) # of the stacked compute, for every image
+        for (path, level), result in zip(files, results):
+            callback_file(path, level, writer(returned(result)), share)
+    def collected_jobs() -> list[tuple[int, Callable[[], None]]]:
+        for files in batches.values():
+            for i in range(0, len(files), batch):
+                estimate_batch = sum(estimate(original_of(path), path, True) for path, _ in files[i:i + batch])
+                jobs.append((estimate_batch, lambda files=files[i:i + batch]: callback_batch(files)))
+        return jobs
+    def queue_dir(path: Path, level: int):
+        events.append((callback_dir if progress == "text" else silent, path, level, False))
+    def queue_file(path: Path, level: int):
+        nonlocal largest
+        is_read_ahead = is_job(path) and is_pending(path)
+        if is_read_ahead and deduplicate: # duplicates are linked when written
+            is_read_ahead = (key := key_of(original_of(path), path)) not in collected
+            collected.add(key)
+        if is_read_ahead and memory_budget is not None:
+            largest = max(largest, estimate(original_of(path), path, False))
+        events.append((callback_file, path, level, is_read_ahead))
+    def read_file(event: tuple, _) -> tuple|None:
+        _, path, _, is_read_ahead = event
+        if is_read_ahead:
+            start = time.perf_counter()
+            try:
+                return read(original_of(path), path)
+            finally:
+                spent[path] = time.perf_counter() - start
+    def compute_file(event: tuple, images: Callable[[], tuple]) -> tuple|None:
+        if event[3]:
+            start = time.perf_counter()
+            try:
+                return compute(*images())
+            finally:
+                spent[event[1]] += time.perf_counter() - start
+    def write_file(event: tuple, result: Callable[[], tuple]):
+        callback, path, level, is_read_ahead = event
+        if is_read_ahead:
+            callback_file(path, level, writer(result), spent.pop(path))
+        else:
+            callback(path, level)
+    if workers == 1 and batch == 1: # read the next image and write the previous one while computing
+        check_out_path(source_path, queue_dir, queue_file)
+        if memory_budget is None or largest * ESTIMATED_PIPELINE_FACTOR <= memory_budget:
+            run_pipeline(events, [read_file, compute_file, write_file])
+        else: # the images read ahead would not fit the budget, one image at a time
+            for callback, path, level, _ in events:
+                callback(path, level)
+    else:
+        run_ordered(source_path, callback_dir, collect_file, is_job, collected_jobs, workers, memory_budget)
+    for path, level in duplicates: # after their first occurrence has been written
+        callback_file(path, level)
+
+
+def create_texture_patch_pack(original_path: Path, modified_path: Path, patch_path: Path, filter_names: list[str] = [], print_full_path: bool = False, overwrite: bool = False, threads: int = 1, progress: str = "text", workers: int = 1, memory_budget: int|None = None, deduplicate: str|None = None, batch: int = 1) -> None:
     error_paths = []
-    def callback_dir(path: Path, level: int):
+    keys: dict[Path, str] = {} # modified path -> content key of the job
+    written: dict[str, Path] = {} # content key -> first patch written for it
+    run_ordered, printers_of = create_ordered_runner(progress)
+    report_job, report_summary = create_json_reporter(count_images(modified_path, SUFFIXES)) if progress == "json" else (silent, silent)
+    def key_of(image_original_path: Path, image_modified_path: Path) -> str:
+        if image_modified_path not in keys:
+            keys[image_modified_path] = pair_key([image_original_path, image_modified_path], filter_names)
+        return keys[image_modified_path]
+    def callback_dir(path: Path, level: int, show: Callable[..., None] = print_indented):
         text = path.name
         if images := [p for p in path.iterdir() if p.is_file and p.suffix.lower() in SUFFIXES]:
             text += f" ({len(images)})" # TODO: /total
-        print_indented(f"{BOLD}{MAGENTA}{text}{RESET}", level)
-    def callback_file(image_modified_path: Path, level: int):
+        show(f"{BOLD}{MAGENTA}{text}{RESET}", level)
+    def callback_file(image_modified_path: Path, level: int, create: Callable[..., None] = create_patch, elapsed: float = 0.0): # seconds already spent on the image before
         if image_modified_path.suffix in SUFFIXES: # and image_modified_path.name == "bch-bench-wood.png":
             relative_replacements_path = image_modified_path.relative_to(modified_path)
             image_patch_path = patch_path.joinpath(relative_replacements_path)
             image_original_path = original_path.joinpath(relative_replacements_path)
             text = (image_original_path if print_full_path else relative_replacements_path).as_posix()
-            print_indented("… " + text, level, end=(None if modified_path == None else "\r"))
+            show, show_message, flush_shown = printers_of(image_modified_path)
+            show("… " + text, level, end=(None if modified_path == None else "\r"))
             image_patch_path.parent.mkdir(parents=True, exist_ok=True)
+            start, status, message = time.perf_counter() - elapsed, "ok", None
             try:
                 if not image_original_path.exists():
                     raise FileNotFoundError("Original file does not exist")
                 elif not overwrite and image_patch_path.exists():
                     raise FileExistsError("Not allowed to overwrite")
-                create_patch(image_original_path, image_modified_path, image_patch_path, filter_names)
+                key = key_of(image_original_path, image_modified_path) if deduplicate else None
+                if key in written:
+                    link_duplicate(written[key], image_patch_path, deduplicate)
+                    status, message = "linked", f"same as {written[key].as_posix()}"
+                else:
+                    unlink_shared(image_patch_path)
+                    create(image_original_path, image_modified_path, image_patch_path, filter_names, threads)
+                    if key:
+                        written[key] = image_patch_path
             except FileExistsError as e:
-                print_indented(f"{GREEN}✖{RESET} {text} SKIPPED: not allowed to overwrite", level, end="\n", flush=True)
+                status, message = "skipped", str(e)
+                show(f"{GREEN}✖{RESET} {text} SKIPPED: not allowed to overwrite", level, end="\n", flush=True)
             except FileNotFoundError as e:
-                print_indented(f"{ORANGE}✖{RESET} {text}", level, end="\t", flush=True)
-                print("warning:", str(e))
+                status, message = "warning", str(e)
+                show(f"{ORANGE}✖{RESET} {text}", level, end="\t", flush=True)
+                show_message("warning:", str(e))
             except Exception as e:
+                status, message = "error", str(e)
                 error_paths.append(image_original_path)
-                print_indented(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
-                print("error:", str(e))
+                show(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
+                show_message("error:", str(e))
             else:
-                print_indented(f"{GREEN}✔{RESET}", level, flush=True) # https://symbolsdb.com/check-mark-symbol
-    check_out_path(modified_path, callback_dir, callback_file)
-    if error_paths:
+                show(f"{GREEN}✔{RESET}" + (f" {text} LINKED" if status == "linked" else ""), level, flush=True) # https://symbolsdb.com/check-mark-symbol
+            flush_shown()
+            report_job(text, status, time.perf_counter() - start, [image_original_path, image_modified_path], [image_patch_path], message)
+    run_pack(modified_path, patch_path, original_path, lambda path: path.suffix in SUFFIXES, callback_dir, callback_file, key_of,
+             lambda image_original_path, image_modified_path: (read_image(image_original_path), read_image(image_modified_path)),
+             lambda original_image, modified_image: (create_patch_image(original_image, modified_image, filter_names, threads), patch_metadata(modified_image, filter_names)),
+             lambda image_original_paths, image_modified_paths: create_patch_batch(image_original_paths, image_modified_paths, filter_names),
+             lambda image_original_path, image_modified_path, is_stacked: estimate_memory(image_original_path, image_modified_path, is_stacked=is_stacked),
+             run_ordered, progress, overwrite, workers, memory_budget, deduplicate, batch)
+    report_summary()
+    if error_paths and progress == "text":
         print(f"Encountered {len(error_paths)} errors:")
         for path in error_paths:
             print("  " + str(path))
 
 
-def create_texture_pack(original_path: Path, patch_path: Path, pack_path: Path, modified_path: Path|None = None, filter_names: list[str] = [], print_full_path: bool = False, overwrite: bool = False) -> None:
+def create_texture_pack(original_path: Path, patch_path: Path, pack_path: Path, modified_path: Path|None = None, filter_names: list[str] = [], print_full_path: bool = False, overwrite: bool = False, threads: int = 1, progress: str = "text", workers: int = 1, memory_budget: int|None = None, deduplicate: str|None = None, batch: int = 1) -> None:
     error_paths = []
-    def callback_dir(path: Path, level: int):
+    keys: dict[Path, str] = {} # patch path -> content key of the job
+    written: dict[str, Path] = {} # content key -> first image written for it
+    run_ordered, printers_of = create_ordered_runner(progress)
+    report_job, report_summary = create_json_reporter(count_images(patch_path)) if progress == "json" else (silent, silent)
+    def key_of(image_original_path: Path, image_patch_path: Path) -> str:
+        if image_patch_path not in keys:
+            keys[image_patch_path] = pair_key([image_original_path, image_patch_path], filter_names)
+        return keys[image_patch_path]
+    def callback_dir(path: Path, level: int, show: Callable[..., None] = print_indented):
         text = path.name
         if images := [p for p in path.iterdir() if p.is_file and p.suffix.lower() in SUFFIXES]:
             text += f" ({len(images)})"
-        print_indented(f"{BOLD}{CYAN}{text}{RESET}", level)
-    def callback_file(image_patch_path: Path, level: int):
+        show(f"{BOLD}{CYAN}{text}{RESET}", level)
+    def callback_file(image_patch_path: Path, level: int, create: Callable[..., None] = create_patched, elapsed: float = 0.0): # seconds already spent on the image before
         relative_replacements_path = image_patch_path.relative_to(patch_path)
         image_pack_path = pack_path.joinpath(relative_replacements_path)
         image_original_path = original_path.joinpath(relative_replacements_path)
         text = (image_pack_path if print_full_path else relative_replacements_path).as_posix()
-        print_indented("… " + text, level, end="\r")
+        show, show_message, flush_shown = printers_of(image_patch_path)
+        show("… " + text, level, end="\r")
         image_pack_path.parent.mkdir(parents=True, exist_ok=True)
+        start, status, message = time.perf_counter() - elapsed, "ok", None
         try:
             if not overwrite and image_pack_path.exists():
                 raise FileExistsError("Not allowed to overwrite")
-            create_patched(image_original_path, image_patch_path, image_pack_path, filter_names)
+            key = key_of(image_original_path, image_patch_path) if deduplicate and image_original_path.exists() else None
+            if key in written:
+                link_duplicate(written[key], image_pack_path, deduplicate)
+                status, message = "linked", f"same as {written[key].as_posix()}"
+            else:
+                unlink_shared(image_pack_path)
+                create(image_original_path, image_patch_path, image_pack_path, filter_names, threads)
+                if key:
+                    written[key] = image_pack_path
             if modified_path:
                 image_modified_path = modified_path.joinpath(relative_replacements_path)
                 if (difference := compare_image(image_modified_path, image_pack_path)) == (0, 0):
-                    print_indented(f"{GREEN}✔{RESET}", level, flush=True) # https://symbolsdb.com/check-mark-symbol
+                    show(f"{GREEN}✔{RESET}" + (f" {text} LINKED" if status == "linked" else ""), level, flush=True) # https://symbolsdb.com/check-mark-symbol
                 else:
-                    print_indented(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
-                    print(f"({BLUE}{difference[0]}{RESET}, {RED}{difference[1]}{RESET})")
+                    status, message = "failed", f"difference {difference}"
+                    show(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
+                    show_message(f"({BLUE}{difference[0]}{RESET}, {RED}{difference[1]}{RESET})")
             else:
-                print_indented(f"{GREEN}✔{RESET}", level, flush=True) # https://symbolsdb.com/check-mark-symbol
+                show(f"{GREEN}✔{RESET}" + (f" {text} LINKED" if status == "linked" else ""), level, flush=True) # https://symbolsdb.com/check-mark-symbol
         except FileExistsError as e:
-            print_indented(f"{GREEN}✖{RESET} {text} SKIPPED: {e}", level, end="\n", flush=True)
+            status, message = "skipped", str(e)
+            show(f"{GREEN}✖{RESET} {text} SKIPPED: {e}", level, end="\n", flush=True)
         except AssertionError as e:
-            print_indented(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
-            print("assertion error:", str(e))
+            status, message = "failed", str(e)
+            show(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
+            show_message("assertion error:", str(e))
         except Exception as e:
+            status, message = "error", str(e)
             error_paths.append(image_original_path)
-            print_indented(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
-            print("error:", str(e))
-    check_out_path(patch_path, callback_dir, callback_file)
-    if error_paths:
+            show(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
+            show_message("error:", str(e))
+        flush_shown()
+        report_job(text, status, time.perf_counter() - start, [image_original_path, image_patch_path], [image_pack_path], message)
+    def compute(original_image: np.ndarray, patch_image: np.ndarray, metadata: dict) -> tuple[np.ndarray]:
+        return create_patched_image(original_image, patch_image, recorded_filter_names(filter_names, metadata), threads, metadata.get("checksum")),
+    run_pack(patch_path, pack_path, original_path, lambda path: True, callback_dir, callback_file, key_of,
+             lambda image_original_path, image_patch_path: (read_image(image_original_path), *read_image_and_metadata(image_patch_path)),
+             compute,
+             lambda image_original_paths, image_patch_paths: [(patched_image,) for patched_image in create_patched_batch(image_original_paths, image_patch_paths, filter_names)],
+             lambda image_original_path, image_patch_path, is_stacked: estimate_memory(image_original_path, image_patch_path, is_patch=True, is_stacked=is_stacked),
+             run_ordered, progress, overwrite, workers, memory_budget, deduplicate, batch)
+    report_summary()
+    if error_paths and progress == "text":
         print(f"Encountered {len(error_paths)} errors:")
         for path in error_paths:
             print("  " + str(path))
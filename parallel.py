@@ -0,0 +1,139 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Any, Callable
+
+from traverse import check_out_path
+from progress import create_ordered_output, create_printers, silent
+
+
+BAND_ALIGNMENT = 8 # rows, so every band of a boolean map packs into whole bytes
+BAND_ROWS = 256
+PIPELINE_DEPTH = 1 # items waiting between two stages, every item can hold decoded images
+
+
+def row_bands(height: int, band_rows: int = BAND_ROWS) -> list[slice]:
+    """
+    Split the rows of an image into bands aligned to BAND_ALIGNMENT rows.
+    The bands only depend on the height, so results never depend on the number of threads.
+    """
+    rows = max(BAND_ALIGNMENT, band_rows - band_rows % BAND_ALIGNMENT)
+    return [slice(start, min(start + rows, height)) for start in range(0, height, rows)]
+
+
+def run_in_bands(function: Callable[[slice], None], height: int, threads: int = 1, band_rows: int = BAND_ROWS) -> None:
+    """
+    Call function for every band of rows, on a thread pool if more than one thread is requested.
+    The function must only write to its own band, NumPy and OpenCV release the GIL while doing so.
+    """
+    assert threads >= 1, "expecting at least one thread"
+    bands = row_bands(height, band_rows)
+    if threads == 1 or len(bands) == 1:
+        for rows in bands:
+            function(rows)
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for future in [executor.submit(function, rows) for rows in bands]:
+                future.result() # reraise exceptions of the band
+
+
+def run_admitted(jobs: list[tuple[int, Callable[[], None]]], workers: int = 1, memory_budget: int|None = None) -> None:
+    """
+    Run (estimated memory, function) jobs on a thread pool, largest first, as long as the running estimates fit the budget.
+    When the largest pending job does not fit, a smaller one that does is started instead.
+    A job that is larger than the whole budget still runs, but only when nothing else is running.
+    """
+    assert workers >= 1, "expecting at least one worker"
+    pending = sorted(jobs, key=lambda job: job[0], reverse=True)
+    running = {}
+    used = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            while pending and len(running) < workers:
+                fits = (i for i, (estimate, _) in enumerate(pending) if not running or memory_budget is None or used + estimate <= memory_budget)
+                if (index := next(fits, None)) is None:
+                    break
+                estimate, function = pending.pop(index)
+                running[executor.submit(function)] = estimate
+                used += estimate
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                used -= running.pop(future)
+                future.result() # reraise exceptions of the job
+
+
+def returned(value: Any) -> Callable[[], Any]:
+    return lambda: value
+
+
+def raised(error: Exception) -> Callable[[], Any]:
+    def reraise():
+        raise error
+    return reraise
+
+
+def run_pipeline(items: list, stages: list[Callable[[Any, Callable[[], Any]], Any]], depth: int = PIPELINE_DEPTH) -> None:
+    """
+    Pass every item in order through the stages, which each run on their own thread and are connected by bounded queues.
+    So e.g. the next image is read and the previous one is written while the current one is computed.
+    A stage is called with the item and a function returning the result of the previous stage, which reraises its exception instead.
+    The last stage runs on the calling thread, its exceptions are raised.
+    """
+    assert stages, "expecting at least one stage"
+    end = object()
+    def stream(source: list|queue.Queue):
+        if isinstance(source, queue.Queue):
+            while (entry := source.get()) is not end:
+                yield entry
+        else:
+            for item in source:
+                yield item, returned(None)
+    def run_stage(stage: Callable[[Any, Callable[[], Any]], Any], source: list|queue.Queue, target: queue.Queue):
+        for item, result in stream(source):
+            try:
+                target.put((item, returned(stage(item, result))))
+            except Exception as e: # passed on to the next stages of the item
+                target.put((item, raised(e)))
+        target.put(end)
+    source = items
+    threads = []
+    for stage in stages[:-1]:
+        target = queue.Queue(maxsize=depth)
+        threads.append(threading.Thread(target=run_stage, args=(stage, source, target), daemon=True)) # don't block exiting on an interrupt
+        source = target
+    for thread in threads:
+        thread.start()
+    for item, result in stream(source):
+        stages[-1](item, result)
+    for thread in threads:
+        thread.join()
+
+
+def create_ordered_runner(progress: str = "text") -> tuple[Callable[..., None], Callable[[Path], tuple[Callable[..., None], Callable[..., None], Callable[[], None]]]]:
+    """
+    Return a function that traverses a directory, collects its jobs and run_admitted() them, and a function returning the printers of a job.
+    While collecting, every directory header and job reserves its place in the text output, so the tree stays in traversal order
+    even when jobs finish out of order. Jobs that were not collected print directly.
+    """
+    reserve = create_ordered_output()
+    places: dict[Path, Callable[[str], None]] = {} # path -> its place in the text output
+    def printers_of(path: Path) -> tuple[Callable[..., None], Callable[..., None], Callable[[], None]]:
+        return create_printers(progress, buffered=path in places, output=places.get(path))
+    def run(target_path: Path, callback_dir: Callable[..., None], collect_file: Callable[[Path, int], None], is_job: Callable[[Path], bool], collected_jobs: Callable[[], list[tuple[int, Callable[[], None]]]], workers: int = 1, memory_budget: int|None = None) -> None:
+        """
+        callback_dir is called with the path, level and the function to print its header with.
+        collect_file is called for every file that is_job, after its place is reserved. The jobs are only taken afterwards.
+        """
+        def collect_dir(path: Path, level: int):
+            show, _, flush_shown = create_printers(progress, buffered=True, output=reserve())
+            callback_dir(path, level, show)
+            flush_shown()
+        def collect_job(path: Path, level: int):
+            if is_job(path):
+                if progress == "text":
+                    places[path] = reserve()
+                collect_file(path, level)
+        check_out_path(target_path, collect_dir if progress == "text" else silent, collect_job)
+        run_admitted(collected_jobs(), workers, memory_budget)
+    return run, printers_of
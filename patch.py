@@ -1,12 +1,28 @@
 from transform import signed, sign_shifted_image, sign_unshifted_image, remainder_ceil, remainder_modulo, resized_to_shape, max_luminance
-from filters import create_noise_image, apply_filters, NOISE_VARIANCE
+from filters import create_noise_image, create_noise_images, apply_filters, NOISE_VARIANCE
+from parallel import run_in_bands
+from metadata import image_checksum, write_image, read_image, read_image_and_metadata, read_metadata
 
 import cv2
 import numpy as np
 from pathlib import Path
 
 
-def pack(image: np.ndarray, positive_maps: list[np.ndarray]):
+PATCH_FORMAT_VERSION = 1 # of the metadata record, the pixel layout of patches is the same as before it
+
+
+def packed_bits(positive_map: np.ndarray, threads: int = 1) -> np.ndarray:
+    BOOLEANS_IN_BYTE = 8
+    row_size = int(np.prod(positive_map.shape[1:]))
+    packed_map = np.empty(-(-positive_map.size // BOOLEANS_IN_BYTE), dtype=np.uint8)
+    def pack_band(rows: slice): # bands start at a multiple of 8 rows, so at a whole byte
+        start, stop = rows.start * row_size // BOOLEANS_IN_BYTE, -(-rows.stop * row_size // BOOLEANS_IN_BYTE)
+        packed_map[start:stop] = np.packbits(positive_map[rows].reshape(-1))
+    run_in_bands(pack_band, positive_map.shape[0], threads)
+    return packed_map
+
+
+def pack(image: np.ndarray, positive_maps: list[np.ndarray], threads: int = 1):
     assert all([image.shape == m.shape for m in positive_maps]), "different map-image shapes"
     pixel_type = image.dtype
     footer_type = np.dtype(np.uint16)
@@ -14,7 +30,7 @@ def pack(image: np.ndarray, positive_maps: list[np.ndarray]):
     packed_shape = np.array(image.shape, dtype=footer_type).view(dtype=pixel_type)
     is_padded = False
     for m in positive_maps:
-        packed_map = np.packbits(m.reshape(-1)).view(dtype=pixel_type)
+        packed_map = packed_bits(m, threads).view(dtype=pixel_type)
         packed = np.append(packed, packed_map)
         BOOLEANS_IN_BYTE = 8
         if (unpacked_size := (packed_map.size * BOOLEANS_IN_BYTE)) > (expected_size := np.prod(m.shape)):
@@ -34,6 +50,39 @@ def pack(image: np.ndarray, positive_maps: list[np.ndarray]):
     return packed_image
 
 
+def pack_stack(images: np.ndarray, positive_maps: list[np.ndarray]) -> np.ndarray:
+    """
+    pack() a stack of images of the same shape at once, the bits of each image are still packed on their own.
+    """
+    assert all([images.shape == m.shape for m in positive_maps]), "different map-image shapes"
+    number_of_images, shape = images.shape[0], images.shape[1:]
+    pixel_type = images.dtype
+    footer_type = np.dtype(np.uint16)
+    BOOLEANS_IN_BYTE = 8
+    packed_maps = [np.packbits(m.reshape(number_of_images, -1), axis=1).view(dtype=pixel_type) for m in positive_maps]
+    is_padded = False
+    for packed_map in packed_maps:
+        if (unpacked_size := (packed_map.shape[1] * BOOLEANS_IN_BYTE)) > (expected_size := np.prod(shape)):
+            if unpacked_size < expected_size + BOOLEANS_IN_BYTE:
+                is_padded |= True
+            else:
+                raise RuntimeError("Unexpected size")
+    row_size = np.prod(shape[1:])
+    packed_shape = np.array(shape, dtype=footer_type).view(dtype=pixel_type)
+    packed_size = int(np.prod(shape)) + sum(packed_map.shape[1] for packed_map in packed_maps)
+    packed_number_of_zeros_size = footer_type.itemsize // pixel_type.itemsize
+    is_padded_size = pixel_type.itemsize // pixel_type.itemsize
+    number_of_zeros = remainder_modulo(packed_size + packed_number_of_zeros_size + is_padded_size + packed_shape.size, row_size)
+    footer = np.concatenate([
+        np.zeros(number_of_zeros, dtype=pixel_type),
+        np.array([is_padded], dtype=pixel_type),
+        np.array([number_of_zeros], dtype=footer_type).view(dtype=pixel_type),
+        packed_shape,
+    ])
+    packed = np.concatenate([images.reshape(number_of_images, -1), *packed_maps, np.broadcast_to(footer, (number_of_images, footer.size))], axis=1)
+    return packed.reshape(number_of_images, -1, *shape[1:])
+
+
 def unpack(packed_image: np.ndarray):
     pixel_type = packed_image.dtype
     footer_type = np.dtype(np.uint16)
@@ -43,12 +92,12 @@ def unpack(packed_image: np.ndarray):
     is_padded_size = pixel_type.itemsize // pixel_type.itemsize
     packed = packed_image.reshape(-1)
     offset = 0
-    shape = tuple(packed[-offset-packed_shape_size:].reshape(-1).view(dtype=footer_type))
+    shape = tuple(int(i) for i in packed[-offset-packed_shape_size:].reshape(-1).view(dtype=footer_type))
     offset += packed_shape_size
-    number_of_zeros = int(packed[-offset-zeros_size:-offset].reshape(-1).view(dtype=footer_type))
+    number_of_zeros = int(packed[-offset-zeros_size:-offset].reshape(-1).view(dtype=footer_type)[0])
     offset += zeros_size
-    is_padded = bool(packed[-offset-is_padded_size:-offset].reshape(-1))
-    image_size = np.prod(shape)
+    is_padded = bool(packed[-offset-is_padded_size:-offset].reshape(-1)[0])
+    image_size = int(np.prod(shape))
     image = packed[:image_size].reshape(shape)
     # row_size = np.prod(shape[1:])
     tail_size = number_of_zeros + is_padded_size + zeros_size + packed_shape_size
@@ -67,56 +116,213 @@ def unpack(packed_image: np.ndarray):
     return image, positive_maps
 
 
-def create_patch(original_path: Path, modified_path: Path, patch_path: Path, filter_names: list[str] = []):
-    original_image = cv2.imread(original_path, cv2.IMREAD_UNCHANGED)
-    modified_image = cv2.imread(modified_path, cv2.IMREAD_UNCHANGED) # for some reason 65535
+def unpack_stack(packed_images: np.ndarray) -> tuple[np.ndarray, list[np.ndarray]]:
+    """
+    unpack() a stack of patches of the same shape at once, the patches must also hold images of the same shape.
+    """
+    number_of_images = packed_images.shape[0]
+    pixel_type = packed_images.dtype
+    footer_type = np.dtype(np.uint16)
+    BOOLEANS_IN_BYTE = 8
+    packed_shape_size = 3 * (footer_type.itemsize // pixel_type.itemsize)
+    zeros_size = footer_type.itemsize // pixel_type.itemsize
+    is_padded_size = pixel_type.itemsize // pixel_type.itemsize
+    packed = packed_images.reshape(number_of_images, -1)
+    shape = tuple(int(i) for i in packed[0, -packed_shape_size:].view(dtype=footer_type))
+    number_of_zeros = int(packed[0, -packed_shape_size-zeros_size:-packed_shape_size].view(dtype=footer_type)[0])
+    is_padded = bool(packed[0, -packed_shape_size-zeros_size-is_padded_size])
+    tail_size = number_of_zeros + is_padded_size + zeros_size + packed_shape_size
+    if not (packed[:, -tail_size:] == packed[0, -tail_size:]).all():
+        raise ValueError("patches hold images of different shapes")
+    image_size = int(np.prod(shape))
+    images = packed[:, :image_size].reshape(number_of_images, *shape)
+    total_map_size = packed.shape[1] - image_size - tail_size
+    number_of_positive_maps = total_map_size * pixel_type.itemsize * BOOLEANS_IN_BYTE // image_size
+    map_size = total_map_size // number_of_positive_maps
+    assert number_of_positive_maps == 2, "expecting 2 maps for now"
+    positive_maps = []
+    for i in range(number_of_positive_maps):
+        offset = image_size + i * map_size
+        bits = np.unpackbits(np.ascontiguousarray(packed[:, offset:offset + map_size]).view(np.uint8), axis=1)
+        if is_padded:
+            bits = bits[:, :image_size] # assumed shape of the map
+        positive_maps.append(bits.reshape(number_of_images, *shape).astype(bool))
+    return images, positive_maps
+
+
+def create_patch_image(original_image: np.ndarray, modified_image: np.ndarray, filter_names: list[str] = [], threads: int = 1) -> np.ndarray:
     resized_image = resized_to_shape(original_image, modified_image.shape)
+    signed_type = np.int16 if modified_image.dtype == np.uint8 else np.int32 # FIXME
+
+    resized: np.ndarray = resized_image.astype(signed_type)
+    noise_image: np.ndarray = create_noise_image(resized, NOISE_VARIANCE)
+    shifted_image = np.empty(modified_image.shape, dtype=modified_image.dtype)
+    difference_is_positive = np.empty(modified_image.shape, dtype=bool)
+    hashed_is_positive = np.empty(modified_image.shape, dtype=bool)
 
-    resized: np.ndarray = resized_image.astype(np.int16 if modified_image.dtype == np.uint8 else np.int32) # FIXME
-    modified: np.ndarray = modified_image.astype(np.int16 if modified_image.dtype == np.uint8 else np.int32) # FIXME
-    noise: np.ndarray = create_noise_image(resized, NOISE_VARIANCE).astype(np.int16 if modified_image.dtype == np.uint8 else np.int32) # FIXME
+    def patch_band(rows: slice):
+        modified: np.ndarray = modified_image[rows].astype(signed_type)
+        noise: np.ndarray = noise_image[rows].astype(signed_type)
+        difference: np.ndarray = modified - resized[rows]
+        difference_is_positive[rows] = difference >= 0
+
+        hashed: np.ndarray = difference - signed(difference_is_positive[rows], noise)
+        hashed_is_positive[rows] = hashed >= 0
+        shifted: np.ndarray = sign_shifted_image(hashed)
+
+        assert shifted.max() < max_luminance(modified_image) + 1, "image has too large value"
+        assert shifted.min() >= 0, "image has too small value"
+        shifted_image[rows] = shifted.astype(modified_image.dtype)
+
+    run_in_bands(patch_band, modified_image.shape[0], threads)
+    packed_image: np.ndarray = pack(shifted_image, [difference_is_positive, hashed_is_positive], threads)
+    patch_image: np.ndarray = apply_filters(packed_image, original_image, filter_names, threads=threads)
+    return patch_image
+
+
+def create_patched_image(original_image: np.ndarray, patch_image: np.ndarray, filter_names: list[str] = [], threads: int = 1, checksum: str|None = None) -> np.ndarray:
+    packed_image: np.ndarray = apply_filters(patch_image, original_image, filter_names, inverted=True, threads=threads)
+    shifted_image, positive_maps = unpack(packed_image)
+    difference_is_positive, hashed_is_positive = positive_maps
+    resized_image: np.ndarray = resized_to_shape(original_image, shifted_image.shape)
+    signed_type = np.int16 if shifted_image.dtype == np.uint8 else np.int32 # FIXME
+
+    resized: np.ndarray = resized_image.astype(signed_type)
+    noise_image: np.ndarray = create_noise_image(resized, NOISE_VARIANCE)
+    patched_image = np.empty(shifted_image.shape, dtype=shifted_image.dtype)
+
+    def patched_band(rows: slice):
+        shifted: np.ndarray = shifted_image[rows].astype(signed_type)
+        hashed: np.ndarray = sign_unshifted_image(hashed_is_positive[rows], shifted)
+        noise: np.ndarray = noise_image[rows].astype(signed_type)
+        difference: np.ndarray = hashed + signed(difference_is_positive[rows], noise)
+        patched: np.ndarray = difference + resized[rows]
+
+        assert patched.max() < max_luminance(patch_image) + 1, "image has too large value"
+        assert patched.min() >= 0, "image has too small value"
+        patched_image[rows] = patched.astype(shifted_image.dtype)
+
+    run_in_bands(patched_band, shifted_image.shape[0], threads)
+    # patched_image[:,:,3] = 0
+    if checksum is not None:
+        assert image_checksum(patched_image) == checksum, "patched image does not match the checksum of the patch"
+    return patched_image
+
+
+def create_patch_images(original_images: list[np.ndarray], modified_images: list[np.ndarray], filter_names: list[str] = []) -> list[np.ndarray]:
+    """
+    create_patch_image() for many small modified images of the same shape and type, stacked into one array.
+    Every image keeps the noise of its own original, so the patches are identical to the ones created one by one.
+    """
+    if len({(image.shape, image.dtype) for image in modified_images}) != 1:
+        raise ValueError("images of different shapes or types")
+    modified_image = np.stack(modified_images)
+    signed_type = np.int16 if modified_image.dtype == np.uint8 else np.int32 # FIXME
+
+    resized: np.ndarray = np.stack([resized_to_shape(image, modified_image.shape[1:]).astype(signed_type) for image in original_images])
+    noise: np.ndarray = create_noise_images(resized, NOISE_VARIANCE).astype(signed_type)
+    modified: np.ndarray = modified_image.astype(signed_type)
     difference: np.ndarray = modified - resized
-    difference_is_positive: np.ndarray = difference >= 0
+    difference_is_positive = difference >= 0
 
     hashed: np.ndarray = difference - signed(difference_is_positive, noise)
-    hashed_is_positive: np.ndarray = hashed >= 0
+    hashed_is_positive = hashed >= 0
     shifted: np.ndarray = sign_shifted_image(hashed)
 
     assert shifted.max() < max_luminance(modified_image) + 1, "image has too large value"
     assert shifted.min() >= 0, "image has too small value"
+    packed_images: np.ndarray = pack_stack(shifted.astype(modified_image.dtype), [difference_is_positive, hashed_is_positive])
+    return [apply_filters(packed_image, original_image, filter_names) for packed_image, original_image in zip(packed_images, original_images)]
 
-    shifted_image: np.ndarray = shifted.astype(modified_image.dtype)
-    packed_image: np.ndarray = pack(shifted_image, [difference_is_positive, hashed_is_positive])
-    patch_image: np.ndarray = apply_filters(packed_image, original_image, filter_names)
-    cv2.imwrite(patch_path, patch_image)
 
-
-def create_patched(original_path: Path, patch_path: Path, patched_path: Path, filter_names: list[str] = []):
-    original_image: np.ndarray = cv2.imread(original_path, cv2.IMREAD_UNCHANGED)
-    patch_image: np.ndarray = cv2.imread(patch_path, cv2.IMREAD_UNCHANGED)
-    packed_image: np.ndarray = apply_filters(patch_image, original_image, filter_names, inverted=True)
-    shifted_image, positive_maps = unpack(packed_image)
+def create_patched_images(original_images: list[np.ndarray], patch_images: list[np.ndarray], filter_names: list[str] = [], checksums: list[str|None]|None = None) -> list[np.ndarray]:
+    """
+    create_patched_image() for many small patches of the same shape and type, stacked into one array.
+    """
+    if len({(image.shape, image.dtype) for image in patch_images}) != 1:
+        raise ValueError("patches of different shapes or types")
+    packed_images = np.stack([apply_filters(patch_image, original_image, filter_names, inverted=True) for patch_image, original_image in zip(patch_images, original_images)])
+    shifted_image, positive_maps = unpack_stack(packed_images)
     difference_is_positive, hashed_is_positive = positive_maps
-    resized_image: np.ndarray = resized_to_shape(original_image, shifted_image.shape)
-
-    shifted = shifted_image.astype(np.int16 if shifted_image.dtype == np.uint8 else np.int32) # FIXME
-    hashed = sign_unshifted_image(hashed_is_positive, shifted)
+    signed_type = np.int16 if shifted_image.dtype == np.uint8 else np.int32 # FIXME
 
-    resized: np.ndarray = resized_image.astype(np.int16 if shifted_image.dtype == np.uint8 else np.int32) # FIXME
-    noise: np.ndarray = create_noise_image(resized, NOISE_VARIANCE).astype(np.int16 if shifted_image.dtype == np.uint8 else np.int32) # FIXME
-    difference = hashed + signed(difference_is_positive, noise)
+    resized: np.ndarray = np.stack([resized_to_shape(image, shifted_image.shape[1:]).astype(signed_type) for image in original_images])
+    noise: np.ndarray = create_noise_images(resized, NOISE_VARIANCE).astype(signed_type)
+    shifted: np.ndarray = shifted_image.astype(signed_type)
+    hashed: np.ndarray = sign_unshifted_image(hashed_is_positive, shifted)
+    difference: np.ndarray = hashed + signed(difference_is_positive, noise)
     patched: np.ndarray = difference + resized
 
-    assert patched.max() < max_luminance(patch_image) + 1, "image has too large value"
+    assert patched.max() < max_luminance(packed_images) + 1, "image has too large value"
     assert patched.min() >= 0, "image has too small value"
+    patched_images = list(patched.astype(shifted_image.dtype))
+    for patched_image, checksum in zip(patched_images, checksums or []):
+        if checksum is not None:
+            assert image_checksum(patched_image) == checksum, "patched image does not match the checksum of the patch"
+    return patched_images
 
-    patched_image: np.ndarray = patched.astype(shifted_image.dtype)
-    # patched_image[:,:,3] = 0
-    cv2.imwrite(patched_path, patched_image)
+
+def patch_metadata(modified_image: np.ndarray, filter_names: list[str] = []) -> dict:
+    """
+    Describe the patch of a modified image, so it can be inspected and planned for without decoding its pixels.
+    """
+    return {
+        "version": PATCH_FORMAT_VERSION,
+        "shape": list(modified_image.shape),
+        "dtype": modified_image.dtype.name,
+        "channels": modified_image.shape[2] if modified_image.ndim > 2 else 1,
+        "filters": list(filter_names),
+        "noise": {"variance": NOISE_VARIANCE},
+        "checksum": image_checksum(modified_image),
+    }
+
+
+def recorded_filter_names(filter_names: list[str], metadata: dict) -> list[str]:
+    """
+    Return the filters to invert: the ones passed, or else the ones recorded in the patch.
+    """
+    return filter_names or metadata.get("filters", [])
+
+
+def create_patch(original_path: Path, modified_path: Path, patch_path: Path, filter_names: list[str] = [], threads: int = 1):
+    original_image = read_image(original_path)
+    modified_image = read_image(modified_path) # for some reason 65535
+    patch_image = create_patch_image(original_image, modified_image, filter_names, threads)
+    write_image(patch_path, patch_image, patch_metadata(modified_image, filter_names))
+
+
+def create_patched(original_path: Path, patch_path: Path, patched_path: Path, filter_names: list[str] = [], threads: int = 1):
+    original_image: np.ndarray = read_image(original_path)
+    patch_image, metadata = read_image_and_metadata(patch_path)
+    patched_image = create_patched_image(original_image, patch_image, recorded_filter_names(filter_names, metadata), threads, metadata.get("checksum"))
+    write_image(patched_path, patched_image)
+
+
+def create_patch_batch(original_paths: list[Path], modified_paths: list[Path], filter_names: list[str] = []) -> list[tuple[np.ndarray, dict]]:
+    """
+    Create the patches of many small images of the same shape at once, returning each patch with its metadata to write.
+    """
+    original_images = [cv2.imread(path, cv2.IMREAD_UNCHANGED) for path in original_paths]
+    modified_images = [cv2.imread(path, cv2.IMREAD_UNCHANGED) for path in modified_paths]
+    patch_images = create_patch_images(original_images, modified_images, filter_names)
+    return [(patch_image, patch_metadata(modified_image, filter_names)) for patch_image, modified_image in zip(patch_images, modified_images)]
+
+
+def create_patched_batch(original_paths: list[Path], patch_paths: list[Path], filter_names: list[str] = []) -> list[np.ndarray]:
+    """
+    Apply many small patches of the same shape at once, returning the patched images to write.
+    """
+    original_images = [cv2.imread(path, cv2.IMREAD_UNCHANGED) for path in original_paths]
+    patch_images = [cv2.imread(path, cv2.IMREAD_UNCHANGED) for path in patch_paths]
+    metadatas = [read_metadata(path) for path in patch_paths]
+    if len({tuple(recorded_filter_names(filter_names, metadata)) for metadata in metadatas}) != 1:
+        raise ValueError("patches recorded with different filters")
+    checksums = [metadata.get("checksum") for metadata in metadatas]
+    return create_patched_images(original_images, patch_images, recorded_filter_names(filter_names, metadatas[0]), checksums)
 
 
-def filter_image(image_path: Path, filtered_path: Path, seed_image_path: Path, fitler_names: list[str], inverted: bool = False):
-    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-    seed_image = cv2.imread(seed_image_path, cv2.IMREAD_UNCHANGED)
-    filtered = apply_filters(image, seed_image, fitler_names, inverted)
-    cv2.imwrite(filtered_path, filtered)
+def filter_image(image_path: Path, filtered_path: Path, seed_image_path: Path, fitler_names: list[str], inverted: bool = False, threads: int = 1):
+    image = read_image(image_path)
+    seed_image = image if seed_image_path == image_path else read_image(seed_image_path)
+    filtered = apply_filters(image, seed_image, fitler_names, inverted, threads)
+    write_image(filtered_path, filtered)
@@ -1,7 +1,9 @@
 from pathlib import Path
 import subprocess
+import time
 from cli import RESET, RED, GREEN, ORANGE, BLUE, MAGENTA, CYAN, BOLD
 from traverse import check_out_path, print_indented
+from progress import create_json_reporter, count_images, silent
 
 
 SUFFIXES = [".png"]
@@ -28,8 +30,10 @@ def run_command(command_template: str, image_original_path: Path, image_processe
         raise e
 
 
-def create_texture_processed_pack(command_template: str, original_path: Path, processed_path: Path, original_placeholder: str = DEFAULT_ORIGINAL_PLACEHOLDER, processed_placeholder: str = DEFAULT_PROCESSED_PLACEHOLDER, print_full_path: bool = False, overwrite: bool = False) -> None:
+def create_texture_processed_pack(command_template: str, original_path: Path, processed_path: Path, original_placeholder: str = DEFAULT_ORIGINAL_PLACEHOLDER, processed_placeholder: str = DEFAULT_PROCESSED_PLACEHOLDER, print_full_path: bool = False, overwrite: bool = False, progress: str = "text") -> None:
     error_paths = []
+    show, show_message = (print_indented, print) if progress == "text" else (silent, silent)
+    report_job, report_summary = create_json_reporter(count_images(original_path, SUFFIXES)) if progress == "json" else (silent, silent)
     def callback_dir(path: Path, level: int):
         text = path.name
         if images := [p for p in path.iterdir() if p.is_file and p.suffix.lower() in SUFFIXES]:
@@ -40,26 +44,31 @@ def create_texture_processed_pack(command_template: str, original_path: Path, pr
             relative_replacements_path = image_original_path.relative_to(original_path)
             image_processed_path = processed_path.joinpath(relative_replacements_path)
             text = (image_original_path if print_full_path else relative_replacements_path).as_posix()
-            print_indented("… " + text, level, end=(None if processed_path == None else "\r"))
+            show("… " + text, level, end=(None if processed_path == None else "\r"))
             image_processed_path.parent.mkdir(parents=True, exist_ok=True)
+            start, status, message = time.perf_counter(), "ok", None
             try:
                 if not overwrite and image_processed_path.exists():
                     raise FileExistsError("Not allowed to overwrite")
                 run_command(command_template, image_original_path, image_processed_path, original_placeholder, processed_placeholder)
             except FileExistsError as e:
-                print_indented(f"{GREEN}✖{RESET} {text} SKIPPED: {e}", level, end="\n", flush=True)
+                status, message = "skipped", str(e)
+                show(f"{GREEN}✖{RESET} {text} SKIPPED: {e}", level, end="\n", flush=True)
             # except FileExistsError as e:
             #     print_indented(f"{ORANGE}✖{RESET} {text}", level, end="\t", flush=True)
             #     print("warning:", str(e))
             except Exception as e:
                 error_paths.append(image_original_path)
-                print_indented(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
-                print("error:", str(e))
+                show(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
+                show_message("error:", str(e))
+                report_job(text, "error", time.perf_counter() - start, [image_original_path], [], str(e))
                 raise e
             else:
-                print_indented(f"{GREEN}✔{RESET}", level, flush=True) # https://symbolsdb.com/check-mark-symbol
-    check_out_path(original_path, callback_dir, callback_file)
-    if error_paths:
+                show(f"{GREEN}✔{RESET}", level, flush=True) # https://symbolsdb.com/check-mark-symbol
+            report_job(text, status, time.perf_counter() - start, [image_original_path], [image_processed_path], message)
+    check_out_path(original_path, callback_dir if progress == "text" else silent, callback_file)
+    report_summary()
+    if error_paths and progress == "text":
         print(f"Encountered {len(error_paths)} errors:")
         for path in error_paths:
             print("  " + str(path))
\ No newline at end of file
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+from traverse import print_indented, INDENTATION
+
+
+PROGRESS_MODES = ["text", "json"]
+AGGREGATE_INTERVAL = 1.0 # seconds between two aggregate events
+BYTES_IN_MEGABYTE = 1_000_000
+
+
+def count_images(target_path: Path, suffixes: list[str]|None = None) -> int:
+    return sum(1 for path in target_path.rglob("*") if path.is_file() and (suffixes is None or path.suffix in suffixes))
+
+
+def file_sizes(paths: list[Path]) -> int:
+    return sum(path.stat().st_size for path in paths if path.is_file())
+
+
+def emit(event: dict) -> None:
+    print(json.dumps(event), flush=True)
+
+
+def silent(*args, **kwargs) -> None:
+    pass
+
+
+def create_ordered_output() -> Callable[[], Callable[[str], None]]:
+    """
+    Return a function that reserves the next place in the output, in traversal order, and returns a function to fill it.
+    Filled text is printed as soon as every place before it is filled, so jobs finishing out of order still print a tree.
+    """
+    lock = threading.Lock()
+    texts: list[str|None] = []
+    printed = 0
+    def reserve() -> Callable[[str], None]:
+        with lock:
+            index = len(texts)
+            texts.append(None)
+        def fill(text: str) -> None:
+            nonlocal printed
+            with lock:
+                texts[index] = text
+                while printed < len(texts) and texts[printed] is not None:
+                    print(texts[printed], end="", flush=True)
+                    texts[printed] = "" # printed, no need to keep it
+                    printed += 1
+        return fill
+    return reserve
+
+
+def create_printers(progress: str, buffered: bool = False, output: Callable[[str], None]|None = None) -> tuple[Callable[..., None], Callable[..., None], Callable[[], None]]:
+    """
+    Return print_indented, print and a flush function for the text progress of one job.
+    When buffered, the lines of the job are only printed at once by the flush, so jobs running in parallel don't interleave.
+    The flush passes them to output instead, when given, e.g. a place reserved by create_ordered_output.
+    """
+    if progress != "text":
+        return silent, silent, silent
+    if not buffered:
+        return print_indented, print, silent
+    lines = []
+    def show(text: str, level: int, end: str|None = None, flush: bool|None = None) -> None:
+        lines.append(INDENTATION * level + text + ("\n" if end is None else end))
+    def show_message(*values) -> None:
+        lines.append(" ".join(str(value) for value in values) + "\n")
+    def flush_shown() -> None:
+        if output:
+            output("".join(lines))
+        else:
+            print("".join(lines), end="", flush=True)
+    return show, show_message, flush_shown
+
+
+def create_json_reporter(total: int, interval: float = AGGREGATE_INTERVAL) -> tuple[Callable[..., None], Callable[[], None]]:
+    """
+    Return a function that emits one json line per finished job, and one for the summary.
+    Every interval seconds, an aggregate progress event with throughput and an ETA over the planned total is added.
+    """
+    start = last = time.perf_counter()
+    lock = threading.Lock() # jobs can report from several threads
+    statuses: dict[str, int] = {}
+    totals = {"done": 0, "bytes_in": 0, "bytes_out": 0}
+    def aggregate(event: str) -> None:
+        elapsed = time.perf_counter() - start
+        images_per_second = totals["done"] / elapsed if elapsed else 0.0
+        emit({
+            "event": event,
+            "done": totals["done"],
+            "total": total,
+            "statuses": statuses,
+            "elapsed": round(elapsed, 3),
+            "images_per_second": round(images_per_second, 3),
+            "megabytes_per_second": round((totals["bytes_in"] + totals["bytes_out"]) / BYTES_IN_MEGABYTE / elapsed, 3) if elapsed else 0.0,
+            "eta": round((total - totals["done"]) / images_per_second, 3) if images_per_second else None,
+        })
+    def report_job(path: str, status: str, duration: float, input_paths: list[Path], output_paths: list[Path], message: str|None = None, details: dict|None = None) -> None:
+        nonlocal last
+        bytes_in, bytes_out = file_sizes(input_paths), (file_sizes(output_paths) if status == "ok" else 0)
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            totals["done"] += 1
+            totals["bytes_in"] += bytes_in
+            totals["bytes_out"] += bytes_out
+            emit({"event": "job", "path": path, "status": status, "duration": round(duration, 6), "bytes_in": bytes_in, "bytes_out": bytes_out, "message": message, **(details or {})})
+            if (now := time.perf_counter()) - last >= interval:
+                last = now
+                aggregate("progress")
+    def report_summary() -> None:
+        aggregate("summary")
+    emit({"event": "start", "total": total})
+    return report_job, report_summary
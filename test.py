@@ -1,17 +1,117 @@
-from patch import create_patch, create_patched
-from difference import compare_image, reverse_original
+from patch import create_patch, create_patched, create_patch_image, create_patched_image, patch_metadata
+from difference import compare_image, reverse_original, image_difference, reverse_unpacked_image, unpack_without_original, difference_stats
+from metadata import encode_png, decode_image, read_image
+from cli import RESET, RED, GREEN, BLUE, MAGENTA, BOLD
+from traverse import check_out_path, print_indented
+from progress import create_json_reporter, count_images, silent
+from parallel import create_ordered_runner
+from memory import estimate_memory
 
+import time
 import numpy as np
 from pathlib import Path
+from typing import Callable
 
 
-def test_patch(original_path: Path, modified_path: Path) -> None:
+SUFFIXES = [".png"]
+
+
+def round_trip(original_image: np.ndarray, modified_image: np.ndarray, filter_names: list[str] = [], threads: int = 1) -> dict:
+    """
+    Create, encode, decode, apply and reverse a patch in memory.
+    Return the (min, max) differences of the patched image with the modified one, and of the reversed image with the original
+    (None when it can't be reversed at all) with its difference_stats(), and the seconds spent on every step.
+    """
+    start = time.perf_counter()
+    patch_image = create_patch_image(original_image, modified_image, filter_names, threads)
+    metadata = patch_metadata(modified_image, filter_names)
+    patch_image = decode_image(encode_png(patch_image, metadata)) # as shipped
+    created = time.perf_counter()
+    patched_image = create_patched_image(original_image, patch_image, filter_names, threads)
+    patched_difference = image_difference(modified_image, patched_image)
+    applied = time.perf_counter()
+    unpacked = unpack_without_original(patch_image, metadata) # filtered patches can't even be unpacked without their original
+    stats = difference_stats(original_image, reverse_unpacked_image(modified_image, unpacked, threads), threads) if unpacked else {} # without the original, as anyone could
+    reversed = time.perf_counter()
+    return {
+        "patched": (int(patched_difference.min()), int(patched_difference.max())),
+        "reversed": stats.get("difference"),
+        "reversed_mean": stats.get("mean"), # the higher, the better the original is protected
+        "reversed_recovered": stats.get("recovered"),
+        "create": round(created - start, 6),
+        "apply": round(applied - created, 6),
+        "reverse": round(reversed - applied, 6),
+    }
+
+
+def test_patch_pack(original_path: Path, modified_path: Path, filter_names: list[str] = [], print_full_path: bool = False, threads: int = 1, progress: str = "text", workers: int = 1, memory_budget: int|None = None) -> None:
+    """
+    Round trip every modified image of a directory with its original in memory, without writing any file.
+    An image passes when the patched image is exactly the modified one.
+    """
+    error_paths = []
+    jobs = []
+    statuses: list[str] = [] # appended from the workers
+    run_ordered, printers_of = create_ordered_runner(progress)
+    report_job, report_summary = create_json_reporter(count_images(modified_path, SUFFIXES)) if progress == "json" else (silent, silent)
+    def callback_dir(path: Path, level: int, show: Callable[..., None] = print_indented):
+        text = path.name
+        if images := [p for p in path.iterdir() if p.is_file and p.suffix.lower() in SUFFIXES]:
+            text += f" ({len(images)})"
+        show(f"{BOLD}{MAGENTA}{text}{RESET}", level)
+    def callback_file(image_modified_path: Path, level: int):
+        if image_modified_path.suffix not in SUFFIXES:
+            return
+        relative_replacements_path = image_modified_path.relative_to(modified_path)
+        image_original_path = original_path.joinpath(relative_replacements_path)
+        text = (image_original_path if print_full_path else relative_replacements_path).as_posix()
+        show, show_message, flush_shown = printers_of(image_modified_path)
+        show("… " + text, level, end="\r")
+        start, status, message, details = time.perf_counter(), "passed", None, None
+        try:
+            if not image_original_path.exists():
+                raise FileNotFoundError("Original file does not exist")
+            details = round_trip(read_image(image_original_path), read_image(image_modified_path), filter_names, threads)
+            patched_difference, reversed_difference = details["patched"], details["reversed"]
+            if patched_difference != (0, 0):
+                status, message = "failed", f"difference {patched_difference}"
+            reversed_text = f"({BLUE}{reversed_difference[0]}{RESET}, {RED}{reversed_difference[1]}{RESET})" if reversed_difference else "not unpackable"
+            show((f"{GREEN}✔{RESET}" if patched_difference == (0, 0) else f"{RED}✖{RESET}") + f" {text}\t({BLUE}{patched_difference[0]}{RESET}, {RED}{patched_difference[1]}{RESET})" +
+                 f" reversed {reversed_text} {time.perf_counter() - start:.3f}s", level, flush=True)
+        except AssertionError as e:
+            status, message = "failed", str(e)
+            show(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
+            show_message("assertion error:", str(e))
+        except Exception as e:
+            status, message = "error", str(e)
+            error_paths.append(image_original_path)
+            show(f"{RED}✖{RESET} {text}", level, end="\t", flush=True)
+            show_message("error:", str(e))
+        statuses.append(status)
+        flush_shown()
+        report_job(text, status, time.perf_counter() - start, [image_original_path, image_modified_path], [], message, details)
+    def collect_file(image_modified_path: Path, level: int):
+        image_original_path = original_path.joinpath(image_modified_path.relative_to(modified_path))
+        jobs.append((estimate_memory(image_original_path, image_modified_path), lambda: callback_file(image_modified_path, level)))
+    start = time.perf_counter()
+    if workers == 1:
+        check_out_path(modified_path, callback_dir if progress == "text" else silent, callback_file)
+    else:
+        run_ordered(modified_path, callback_dir, collect_file, lambda path: path.suffix in SUFFIXES, lambda: jobs, workers, memory_budget)
+    report_summary()
+    if progress == "text":
+        print(f"{statuses.count('passed')} passed, {statuses.count('failed')} failed, {statuses.count('error')} errors in {time.perf_counter() - start:.1f}s")
+        for path in error_paths:
+            print("  " + str(path))
+
+
+def test_patch(original_path: Path, modified_path: Path, filter_names: list[str] = []) -> None:
     patch_path = modified_path.with_stem(original_path.stem + "-patch-v8-1").with_suffix(".png") # must be lossless
     patched_path = modified_path.with_stem(original_path.stem + "-patched-v8-1").with_suffix(modified_path.suffix)
     reversed_path = modified_path.with_stem(original_path.stem + "-reversed-v8-1").with_suffix(modified_path.suffix)
     difference_path = modified_path.with_stem(original_path.stem + "-difference-v8-1").with_suffix(modified_path.suffix)
-    create_patch(original_path, modified_path, patch_path)
-    create_patched(original_path, patch_path, patched_path)
+    create_patch(original_path, modified_path, patch_path, filter_names)
+    create_patched(original_path, patch_path, patched_path, filter_names)
     if (difference := compare_image(modified_path, patched_path, difference_path)) != (0, 0):
         print("patched difference:", difference)
     reverse_original(modified_path, patch_path, reversed_path)
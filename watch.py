@@ -0,0 +1,154 @@
+from patch import create_patch_image, create_patched_image, patch_metadata, recorded_filter_names
+from cli import RESET, RED, GREEN, ORANGE, BOLD
+from traverse import print_indented
+from metadata import write_image, read_metadata
+from deduplicate import unlink_shared
+
+import os
+import time
+import cv2
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable
+
+
+SUFFIXES = [".png"]
+POLL_INTERVAL = 0.25 # seconds between two scans of the watched directory
+DEBOUNCE_TIME = 0.2 # seconds a file must stay unchanged before it is handled
+CACHED_IMAGES = 64
+
+
+def scan_files(target_path: Path, suffixes: list[str] = SUFFIXES) -> dict[str, tuple[int, int]]:
+    """
+    Map every image below target_path to its (modification time, size).
+    Plain os.scandir strings instead of pathlib keep a poll of 20k files under 0.1s.
+    """
+    files = {}
+    directories = [str(target_path)]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(entry.path)
+                elif os.path.splitext(entry.name)[1] in suffixes:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError: # removed while scanning
+                        continue
+                    files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def create_image_reader(max_images: int = CACHED_IMAGES) -> Callable[[Path], np.ndarray]:
+    """
+    Return a cv2.imread that keeps the last max_images decoded images, until their file changes.
+    """
+    images: OrderedDict[tuple[Path, int, int], np.ndarray] = OrderedDict()
+    def read_image(path: Path) -> np.ndarray:
+        stat = path.stat()
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        if key in images:
+            images.move_to_end(key)
+            return images[key]
+        image = read_uncached_image(path)
+        images[key] = image
+        if len(images) > max_images:
+            images.popitem(last=False)
+        return image
+    return read_image
+
+
+def read_uncached_image(path: Path) -> np.ndarray:
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Could not read {path.name}") # e.g. still being written
+    return image
+
+
+def watch_path(target_path: Path, output_path_of: Callable[[Path], Path], callback_file: Callable[[Path], None], interval: float = POLL_INTERVAL, debounce: float = DEBOUNCE_TIME) -> None:
+    """
+    Call callback_file for every image that is outdated compared to its output, then keep polling target_path
+    and call it again for every new or changed image once it stopped changing for debounce seconds.
+    """
+    known = scan_files(target_path)
+    for path, (modified_time, _) in known.items():
+        output_path = output_path_of(Path(path))
+        if not output_path.exists() or output_path.stat().st_mtime_ns < modified_time:
+            callback_file(Path(path))
+    print(f"{BOLD}Watching {target_path.as_posix()} for changes{RESET} (press Ctrl+C to stop)", flush=True)
+    pending: dict[str, float] = {} # path -> time the last change was seen
+    try:
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            current = scan_files(target_path)
+            for path, stat in current.items():
+                if known.get(path) != stat:
+                    pending[path] = now
+            known = current
+            pending = {path: seen for path, seen in pending.items() if path in current}
+            for path in [path for path, seen in pending.items() if now - seen >= debounce]:
+                del pending[path]
+                callback_file(Path(path))
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+
+def watch_texture_patch_pack(original_path: Path, modified_path: Path, patch_path: Path, filter_names: list[str] = [], print_full_path: bool = False, threads: int = 1) -> None:
+    read_original = create_image_reader()
+    def callback_file(image_modified_path: Path):
+        relative_replacements_path = image_modified_path.relative_to(modified_path)
+        image_patch_path = patch_path.joinpath(relative_replacements_path)
+        image_original_path = original_path.joinpath(relative_replacements_path)
+        text = (image_original_path if print_full_path else relative_replacements_path).as_posix()
+        print_indented("… " + text, 0, end="\r", flush=True)
+        start = time.perf_counter()
+        try:
+            if not image_original_path.exists():
+                raise FileNotFoundError("Original file does not exist")
+            image_patch_path.parent.mkdir(parents=True, exist_ok=True)
+            modified_image = read_uncached_image(image_modified_path)
+            patch_image = create_patch_image(read_original(image_original_path), modified_image, filter_names, threads)
+            unlink_shared(image_patch_path)
+            write_image(image_patch_path, patch_image, patch_metadata(modified_image, filter_names))
+        except FileNotFoundError as e:
+            print_indented(f"{ORANGE}✖{RESET} {text}", 0, end="\t", flush=True)
+            print("warning:", str(e))
+        except Exception as e:
+            print_indented(f"{RED}✖{RESET} {text}", 0, end="\t", flush=True)
+            print("error:", str(e))
+        else:
+            print_indented(f"{GREEN}✔{RESET} {text} ({time.perf_counter() - start:.2f}s)", 0, flush=True)
+    watch_path(modified_path, lambda path: patch_path.joinpath(path.relative_to(modified_path)), callback_file)
+
+
+def watch_texture_pack(original_path: Path, patch_path: Path, pack_path: Path, filter_names: list[str] = [], print_full_path: bool = False, threads: int = 1) -> None:
+    read_original = create_image_reader()
+    def callback_file(image_patch_path: Path):
+        relative_replacements_path = image_patch_path.relative_to(patch_path)
+        image_pack_path = pack_path.joinpath(relative_replacements_path)
+        image_original_path = original_path.joinpath(relative_replacements_path)
+        text = (image_pack_path if print_full_path else relative_replacements_path).as_posix()
+        print_indented("… " + text, 0, end="\r", flush=True)
+        start = time.perf_counter()
+        try:
+            if not image_original_path.exists():
+                raise FileNotFoundError("Original file does not exist")
+            image_pack_path.parent.mkdir(parents=True, exist_ok=True)
+            metadata = read_metadata(image_patch_path)
+            patched_image = create_patched_image(read_original(image_original_path), read_uncached_image(image_patch_path), recorded_filter_names(filter_names, metadata), threads, metadata.get("checksum"))
+            unlink_shared(image_pack_path)
+            cv2.imwrite(image_pack_path, patched_image)
+        except FileNotFoundError as e:
+            print_indented(f"{ORANGE}✖{RESET} {text}", 0, end="\t", flush=True)
+            print("warning:", str(e))
+        except AssertionError as e:
+            print_indented(f"{RED}✖{RESET} {text}", 0, end="\t", flush=True)
+            print("assertion error:", str(e))
+        except Exception as e:
+            print_indented(f"{RED}✖{RESET} {text}", 0, end="\t", flush=True)
+            print("error:", str(e))
+        else:
+            print_indented(f"{GREEN}✔{RESET} {text} ({time.perf_counter() - start:.2f}s)", 0, flush=True)
+    watch_path(patch_path, lambda path: pack_path.joinpath(path.relative_to(patch_path)), callback_file)